@@ -0,0 +1,419 @@
+import math
+import numpy
+
+CLS = 0.05
+QUANTILES = [('m2s', -2.), ('m1s', -1.), ('med', 0.), ('p1s', 1.), ('p2s', 2.)]
+
+# number of signal points minimized together (memory scales as CHUNK x nParams^2)
+CHUNK = 32
+
+def normalCDF(x):
+    return 0.5 * math.erfc(-x / math.sqrt(2.))
+
+
+def normalQuantile(p):
+    """
+    Inverse of normalCDF by bisection (only called a handful of times per point)
+    """
+
+    low = -40.
+    high = 40.
+    while high - low > 1.e-12:
+        mid = 0.5 * (low + high)
+        if normalCDF(mid) < p:
+            low = mid
+        else:
+            high = mid
+
+    return 0.5 * (low + high)
+
+
+def calcCLs(qmu, qA):
+    """
+    CLs from arrays of the observed and Asimov q~_mu test statistics, in the same form as combine AsymptoticLimits
+    """
+
+    sqmu = numpy.sqrt(numpy.maximum(qmu, 0.))
+    sqA = numpy.sqrt(numpy.maximum(qA, 0.))
+
+    phi = numpy.vectorize(normalCDF)
+
+    tail = (sqA > 0.) & (qmu > qA)
+    denom = numpy.where(tail, 2. * sqA, 1.)
+
+    CLsb = numpy.where(tail, 1. - phi((qmu + qA) / denom), 1. - phi(sqmu))
+    CLb = numpy.where(tail, 1. - phi((qmu - qA) / denom), phi(sqA - sqmu))
+
+    return numpy.where(CLb > 0., CLsb / numpy.where(CLb > 0., CLb, 1.), 0.)
+
+
+def findCrossing(func, target, start):
+    """
+    Find r > 0 (one per point) where the monotonically increasing func(r) crosses target. The brackets are expanded geometrically from start and refined with the Illinois (modified regula falsi) method.
+    Points that do not converge within the iteration limit get NaN.
+    """
+
+    low = numpy.zeros_like(start)
+    high = start.copy()
+    fLow = func(low) - target
+    fHigh = func(high) - target
+
+    for iExpand in range(60):
+        below = fHigh < 0.
+        if not numpy.any(below): break
+        low = numpy.where(below, high, low)
+        fLow = numpy.where(below, fHigh, fLow)
+        high = numpy.where(below, high * 2., high)
+        fHigh = numpy.where(below, func(high) - target, fHigh)
+    else:
+        raise RuntimeError('Could not bracket the limit')
+
+    running = numpy.ones(start.shape, dtype = bool)
+    for iIter in range(100):
+        denom = numpy.where(fHigh != fLow, fHigh - fLow, 1.)
+        mid = numpy.where(running, high - fHigh * (high - low) / denom, high)
+        fMid = func(mid) - target
+
+        crossed = fMid * fHigh < 0.
+        low, fLow = numpy.where(crossed, high, low), numpy.where(crossed, fHigh, numpy.where(running, fLow * 0.5, fLow))
+        running &= numpy.abs(mid - high) > 1.e-6 * mid
+        high, fHigh = mid, fMid
+
+        if not numpy.any(running): break
+
+    return numpy.where(running, numpy.nan, high)
+
+
+class CountingModel(object):
+    """
+    Likelihood of the multi-bin counting experiment described by a set of Channels, equivalent to the datacard written by datacard.writeDataCard, for a batch of signal points sharing the channel structure.
+    Each (channel, process) is a term with expected yield
+      lambda = r^{isSignal} * c * exp(kappa . theta + g * u)
+    where theta are the lnN nuisances (unit Gaussian constraint) and u = log(n) are the per-term gmN yields (Poisson constraint by the MC count; g = 0 for terms without gmN).
+    All arrays carry the point index as the leading axis.
+    """
+
+    def __init__(self, channelsList):
+        channelNames = sorted(channelsList[0].keys())
+        processNames = sorted(set([name for channel in channelsList[0].values() for name in channel.processes.keys()]))
+        nuisanceNames = sorted(set([name for channels in channelsList for channel in channels.values() for process in channel.processes.values() for name in process.nuisances.keys()]))
+
+        terms = [(ch, proc) for ch in channelNames for proc in processNames]
+
+        nPoints = len(channelsList)
+        nTerms = len(terms)
+        nNuis = len(nuisanceNames)
+
+        self.nPoints = nPoints
+        self.nChannels = len(channelNames)
+        self.nTerms = nTerms
+        self.nNuis = nNuis
+        self.nParams = nNuis + nTerms
+
+        self.channel = numpy.array([channelNames.index(ch) for ch, proc in terms], dtype = int)
+        self.signal = numpy.array([proc == 'signal' for ch, proc in terms], dtype = bool)
+
+        self.logc = numpy.zeros((nPoints, nTerms))
+        self.active = numpy.zeros((nPoints, nTerms))
+        self.kappa = numpy.zeros((nPoints, nTerms, nNuis))
+        self.hasGmN = numpy.zeros((nPoints, nTerms))
+        self.globalCounts = numpy.zeros((nPoints, nTerms))
+        self.observed = numpy.zeros((nPoints, self.nChannels))
+
+        for iP, channels in enumerate(channelsList):
+            for iC, ch in enumerate(channelNames):
+                self.observed[iP, iC] = channels[ch].observed
+
+            for iT, (ch, proc) in enumerate(terms):
+                process = channels[ch].processes[proc]
+                rate = process.rate()
+                if rate <= 0.: continue
+
+                self.active[iP, iT] = 1.
+
+                for iN, nuis in enumerate(nuisanceNames):
+                    # same threshold as writeDataCard
+                    if nuis in process.nuisances and abs(process.nuisances[nuis]) >= 0.001:
+                        self.kappa[iP, iT, iN] = math.log(1. + process.nuisances[nuis])
+
+                count = process.count()
+                if count == 0:
+                    self.logc[iP, iT] = math.log(rate)
+                else:
+                    self.logc[iP, iT] = math.log(rate / count)
+                    self.hasGmN[iP, iT] = 1.
+                    self.globalCounts[iP, iT] = count
+
+        # channel x term incidence matrix
+        self.incidence = numpy.zeros((self.nChannels, nTerms))
+        self.incidence[self.channel, numpy.arange(nTerms)] = 1.
+        self.sameChannel = (self.channel[:, numpy.newaxis] == self.channel[numpy.newaxis, :]).astype(float)
+
+        self.globalTheta = numpy.zeros((nPoints, nNuis))
+
+        self.nominal = numpy.concatenate((numpy.zeros((nPoints, nNuis)), numpy.where(self.hasGmN > 0., numpy.log(numpy.maximum(self.globalCounts, 1.e-9)), 0.)), axis = 1)
+
+    def subset(self, points):
+        """
+        Model restricted to the given point indices.
+        """
+
+        model = object.__new__(CountingModel)
+        model.__dict__.update(self.__dict__)
+        for attr in ['logc', 'active', 'kappa', 'hasGmN', 'globalCounts', 'observed', 'globalTheta', 'nominal']:
+            setattr(model, attr, getattr(self, attr)[points])
+
+        model.nPoints = model.logc.shape[0]
+
+        return model
+
+    def hasSignal(self):
+        return numpy.any(self.active[:, self.signal] > 0., axis = 1)
+
+    def unscaledYields(self, params):
+        exponent = self.logc + numpy.matmul(self.kappa, params[:, :self.nNuis, numpy.newaxis])[:, :, 0] + self.hasGmN * params[:, self.nNuis:]
+        return self.active * numpy.exp(exponent)
+
+    def yields(self, r, params):
+        lam = self.unscaledYields(params)
+        return numpy.where(self.signal, r[:, numpy.newaxis] * lam, lam)
+
+    def nll(self, r, params, data, globalTheta, globalCounts):
+        mu = self.yields(r, params).dot(self.incidence.T)
+        theta = params[:, :self.nNuis]
+        u = params[:, self.nNuis:]
+
+        logmu = numpy.log(numpy.where(data > 0., mu, 1.))
+
+        val = numpy.sum(mu - data * logmu, axis = 1)
+        val += 0.5 * numpy.sum(numpy.square(theta - globalTheta), axis = 1)
+        val += numpy.sum(numpy.where(self.hasGmN > 0., numpy.exp(u) - globalCounts * u, 0.5 * numpy.square(u)), axis = 1)
+
+        return val
+
+    def slope(self, r, params, data):
+        """
+        Derivative of the NLL with respect to r. At the conditional minimum this is the derivative of the profiled NLL.
+        """
+
+        lam = self.unscaledYields(params)
+        mu = numpy.where(self.signal, r[:, numpy.newaxis] * lam, lam).dot(self.incidence.T)
+        ratio = numpy.where(mu > 0., data / numpy.where(mu > 0., mu, 1.), 0.)
+
+        return numpy.sum(((1. - ratio[:, self.channel]) * lam)[:, self.signal], axis = 1)
+
+    def derivatives(self, r, params, data, globalTheta, globalCounts):
+        """
+        Gradient and Hessian of the NLL with respect to params. Built block by block (theta-theta, theta-u, u-u) since the u-u block only couples terms within a channel.
+        """
+
+        nNuis = self.nNuis
+        lam = self.yields(r, params)
+        mu = lam.dot(self.incidence.T)
+        safeMu = numpy.where(mu > 0., mu, 1.)
+        ratio = numpy.where(mu > 0., data / safeMu, 0.)
+
+        # per-term weights of the first and second derivative terms of sum_c (mu_c - d_c log mu_c)
+        first = 1. - ratio[:, self.channel]
+        second = (ratio / safeMu)[:, self.channel]
+
+        lamKappa = lam[:, :, numpy.newaxis] * self.kappa
+        lamG = lam * self.hasGmN
+        chKappa = numpy.tensordot(lamKappa, self.incidence, axes = ([1], [1])) # (points, nuis, channels)
+
+        u = params[:, nNuis:]
+        gmN = self.hasGmN > 0.
+
+        grad = numpy.empty((self.nPoints, self.nParams))
+        grad[:, :nNuis] = numpy.sum(first[:, :, numpy.newaxis] * lamKappa, axis = 1) + params[:, :nNuis] - globalTheta
+        grad[:, nNuis:] = first * lamG + numpy.where(gmN, numpy.exp(u) - globalCounts, u)
+
+        hess = numpy.empty((self.nPoints, self.nParams, self.nParams))
+
+        hessNN = numpy.sum((first[:, :, numpy.newaxis] * lamKappa)[:, :, :, numpy.newaxis] * self.kappa[:, :, numpy.newaxis, :], axis = 1)
+        hessNN += numpy.sum((chKappa * (ratio / safeMu)[:, numpy.newaxis, :])[:, :, numpy.newaxis, :] * chKappa[:, numpy.newaxis, :, :], axis = 3)
+        hessNN[:, numpy.arange(nNuis), numpy.arange(nNuis)] += 1.
+        hess[:, :nNuis, :nNuis] = hessNN
+
+        hessNU = (first * lamG)[:, numpy.newaxis, :] * self.kappa.transpose(0, 2, 1) + chKappa[:, :, self.channel] * (second * lamG)[:, numpy.newaxis, :]
+        hess[:, :nNuis, nNuis:] = hessNU
+        hess[:, nNuis:, :nNuis] = hessNU.transpose(0, 2, 1)
+
+        hessUU = (second * lamG)[:, :, numpy.newaxis] * lamG[:, numpy.newaxis, :] * self.sameChannel
+        diagU = numpy.arange(self.nTerms)
+        hessUU[:, diagU, diagU] += first * lamG + numpy.where(gmN, numpy.exp(u), 1.)
+        hess[:, nNuis:, nNuis:] = hessUU
+
+        return grad, hess
+
+    def profile(self, r, data, globalTheta, globalCounts, start = None):
+        """
+        Minimize the NLL over nuisances at fixed r (one value per point) with a damped Newton iteration. Returns (nll, params).
+        """
+
+        if start is None:
+            params = self.nominal.copy()
+        else:
+            params = start.copy()
+
+        identity = numpy.eye(self.nParams)
+
+        damping = numpy.full(self.nPoints, 1.e-6)
+        current = self.nll(r, params, data, globalTheta, globalCounts)
+        running = numpy.ones(self.nPoints, dtype = bool)
+
+        # only the points still being minimized are carried through each iteration
+        points = numpy.arange(self.nPoints)
+        sub = self
+
+        for iIter in range(500):
+            if len(points) != numpy.count_nonzero(running):
+                points = numpy.flatnonzero(running)
+                if len(points) == 0: break
+                sub = self.subset(points)
+
+            args = (r[points], data[points], globalTheta[points], globalCounts[points])
+
+            grad, hess = sub.derivatives(args[0], params[points], *args[1:])
+
+            converged = numpy.max(numpy.abs(grad), axis = 1) < 1.e-9
+            if numpy.any(converged):
+                running[points[converged]] = False
+                continue
+
+            try:
+                step = numpy.linalg.solve(hess + damping[points, numpy.newaxis, numpy.newaxis] * identity, -grad[:, :, numpy.newaxis])[:, :, 0]
+            except numpy.linalg.LinAlgError:
+                damping[points] *= 10.
+                running[points] = damping[points] < 1.e10
+                continue
+
+            trial = params[points] + step
+            value = sub.nll(args[0], trial, *args[1:])
+            accept = numpy.isfinite(value) & (value <= current[points])
+
+            improvement = numpy.where(accept, current[points] - value, 0.)
+            params[points[accept]] = trial[accept]
+            current[points[accept]] = value[accept]
+            damping[points] = numpy.where(accept, numpy.maximum(damping[points] * 0.1, 1.e-9), damping[points] * 10.)
+
+            running[points] = ~(accept & (improvement < 1.e-12)) & (damping[points] < 1.e10)
+
+        return current, params
+
+
+def limits(model):
+    """
+    Observed and expected limits for all points of the model. Returns a dict quantile -> array of limits, or raises RuntimeError if the brackets could not be found.
+    """
+
+    data = model.observed
+    gTheta = model.globalTheta
+    gCounts = model.globalCounts
+    zero = numpy.zeros(model.nPoints)
+
+    # background-only fit to data defines the Asimov dataset and global observables
+    nllData0, params0 = model.profile(zero, data, gTheta, gCounts)
+
+    asimov = model.yields(zero, params0).dot(model.incidence.T)
+    aTheta = params0[:, :model.nNuis].copy()
+    aCounts = numpy.where(model.hasGmN > 0., numpy.exp(params0[:, model.nNuis:]), 0.)
+
+    nllAsimov0 = model.nll(zero, params0, asimov, aTheta, aCounts)
+
+    state = {'data': params0, 'asimov': params0}
+
+    def profileData(r):
+        val, state['data'] = model.profile(r, data, gTheta, gCounts, state['data'])
+        return val
+
+    def qAsimov(r):
+        val, state['asimov'] = model.profile(r, asimov, aTheta, aCounts, state['asimov'])
+        return numpy.maximum(2. * (val - nllAsimov0), 0.)
+
+    signalTotal = numpy.sum(numpy.exp(model.logc) * model.active * model.signal, axis = 1)
+    start = 1. / signalTotal
+
+    # best fit r (bounded at 0) from the sign of the profiled derivative
+    def slope(r):
+        profileData(r)
+        return model.slope(r, state['data'], data)
+
+    atZero = slope(zero) >= 0.
+    if numpy.all(atZero):
+        rhat = zero
+    else:
+        rhat = numpy.where(atZero, 0., findCrossing(lambda r: numpy.where(atZero, 1., slope(r)), 0., start))
+
+    nllDataMin = numpy.where(atZero, nllData0, profileData(rhat))
+
+    def oneMinusCLs(r):
+        qmu = numpy.where(r > rhat, 2. * (profileData(r) - nllDataMin), 0.)
+        return 1. - calcCLs(qmu, qAsimov(r))
+
+    result = {}
+    result['obs'] = findCrossing(oneMinusCLs, 1. - CLS, start)
+
+    for quant, nsigma in QUANTILES:
+        target = nsigma + normalQuantile(1. - CLS * normalCDF(nsigma))
+        result[quant] = findCrossing(lambda r: numpy.sqrt(qAsimov(r)), target, start)
+
+    result['valid'] = numpy.isfinite(nllDataMin)
+    for quant in ['obs'] + [q for q, n in QUANTILES]:
+        result['valid'] &= numpy.isfinite(result[quant])
+
+    return result
+
+
+def asymptoticBatch(channelsList):
+    """
+    In-process equivalent of combine -M Asymptotic for a list of lnN/gmN counting models (dicts of Channels with identical channel and process names).
+    Returns a list with one dict quantile -> limit per entry, or None where the calculation failed.
+    """
+
+    model = CountingModel(channelsList)
+
+    results = [None] * model.nPoints
+
+    points = numpy.flatnonzero(model.hasSignal())
+
+    for iChunk in range(0, len(points), CHUNK):
+        chunk = points[iChunk:iChunk + CHUNK]
+
+        try:
+            chunkLimits = limits(model.subset(chunk))
+        except RuntimeError:
+            if len(chunk) == 1: continue
+            # retry one by one to isolate the problematic point
+            chunkLimits = None
+
+        for iP, point in enumerate(chunk):
+            if chunkLimits is None:
+                try:
+                    pointLimits = limits(model.subset([point]))
+                except RuntimeError:
+                    continue
+                iP = 0
+            else:
+                pointLimits = chunkLimits
+
+            if not pointLimits['valid'][iP]: continue
+
+            results[point] = dict([(quant, pointLimits[quant][iP]) for quant in ['obs'] + [q for q, n in QUANTILES]])
+
+    return results
+
+
+def asymptotic(channels, vLimits):
+    """
+    In-process equivalent of combine -M Asymptotic for lnN/gmN counting channels. Fills vLimits and returns True on success.
+    """
+
+    result = asymptoticBatch([channels])[0]
+    if result is None:
+        return False
+
+    for quant, limit in result.items():
+        vLimits[quant][0] = limit
+
+    return True
@@ -1,4 +1,5 @@
 import os
+import re
 import pickle
 import shutil
 import array
@@ -8,18 +9,20 @@ import subprocess
 import ROOT
 
 import datacard
+import hybridGrid
+import signalStore
 
 SETENV = 'cd /afs/cern.ch/user/y/yiiyama/cmssw/Combine612; eval `scram runtime -sh`;'
 NSTEPS = 100
+NSIGMA = 3.
 
-def makeGrid(model, point, index, datadir, outputdir):
+def getBounds(model, point, datadir):
+    """
+    Log of the r-value range of the grid for the point, from the asymptotic limits in {model}.root
+    """
 
     pointName = model + '_' + point
 
-    # get rvalue range from {model}.root
-
-    print 'Calculating rvalue for index', index
-
     limitFile = ROOT.TFile.Open(datadir + '/' + model + '.root')
     limitTree = limitFile.Get('limitTree')
 
@@ -44,19 +47,64 @@ def makeGrid(model, point, index, datadir, outputdir):
 
     limitFile.Close()
 
+    return lnrlow, lnrhigh
+
+
+def nextIndices(model, point, datadir, griddir, precision):
+    """
+    Adaptive driver: grid indices to submit next, given the grid files already in griddir. Starts from a coarse subset of the NSTEPS indices and adds the indices closest to the CLs = 0.05 crossings until they are bracketed to the given precision or by adjacent indices. Raises if a crossing lies outside the grid range.
+    """
+
+    lnrlow, lnrhigh = getBounds(model, point, datadir)
+
+    doneIndices = set()
+    gridFiles = []
+    if os.path.isdir(griddir):
+        for fileName in os.listdir(griddir):
+            matches = re.match('higgsCombineGrid([0-9]+)[.]HybridNew[.].*[.]root$', fileName)
+            if matches:
+                doneIndices.add(int(matches.group(1)))
+                gridFiles.append(griddir + '/' + fileName)
+
+    if len(doneIndices) == 0:
+        return range(0, NSTEPS, NSTEPS / 8) + [NSTEPS - 1]
+
+    rvalues = hybridGrid.nextRValues(hybridGrid.clsTable(hybridGrid.readGrid(gridFiles)), precision)
+
+    indices = set()
+    for rval in rvalues:
+        if math.log(rval) < lnrlow or math.log(rval) > lnrhigh:
+            # the crossing cannot be bracketed on this grid; clamping would drop it silently
+            raise RuntimeError('r = %g needed to bracket the limit is outside the grid range [%g, %g]' % (rval, math.exp(lnrlow), math.exp(lnrhigh)))
+
+        index = int(round((math.log(rval) - lnrlow) / (lnrhigh - lnrlow) * NSTEPS))
+        index = min(max(index, 0), NSTEPS - 1)
+        if index not in doneIndices:
+            indices.add(index)
+
+    return sorted(indices)
+
+
+def makeGrid(model, point, index, datadir, outputdir, sequential = False):
+
+    pointName = model + '_' + point
+
+    # get rvalue range from {model}.root
+
+    print 'Calculating rvalue for index', index
+
+    lnrlow, lnrhigh = getBounds(model, point, datadir)
+
     rval = math.exp(lnrlow + (lnrhigh - lnrlow) / NSTEPS * index)
 
-    # prepare data card from result.pkl (observation & exp errors) and {model}.pkl (signal expectation)
+    # prepare data card from result.pkl (observation & exp errors) and the {model} signal store (signal expectation)
 
     print 'Preparing data card'
 
     with open(datadir + '/result.pkl') as source:
         channels = pickle.load(source)
 
-    with open(datadir + '/' + model + '.pkl') as source:
-        signals = pickle.load(source)
-
-    signalData = signals[pointName][0]
+    signalData = signalStore.openSignals(datadir, model)[pointName][0]
     for name, channel in channels.items():
         channel.processes['signal'] = signalData[name]
 
@@ -70,49 +118,96 @@ def makeGrid(model, point, index, datadir, outputdir):
     # run combine
 
     suffix = 'Grid' + str(index)
-    command = 'combine ' + cardPath + ' -n ' + suffix + ' -M HybridNew -s -1 --freq --clsAcc 0 -T 500 -i 4 --fork 4 --saveToys --saveHybridResult --singlePoint ' + str(rval)
 
-    print command
+    if sequential:
+        # same total number of toys as the -i 4 default, in one iteration per chunk; stop once CLs is clearly away from 0.05
+        commands = ['combine ' + cardPath + ' -n ' + suffix + ' -M HybridNew -s -1 --freq --clsAcc 0 -T 500 -i 1 --fork 4 --saveToys --saveHybridResult --singlePoint ' + str(rval)] * 4
+    else:
+        commands = ['combine ' + cardPath + ' -n ' + suffix + ' -M HybridNew -s -1 --freq --clsAcc 0 -T 500 -i 4 --fork 4 --saveToys --saveHybridResult --singlePoint ' + str(rval)]
+
+    for command in commands:
+        print command
+
+        proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; ' + command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
 
-    proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; ' + command, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        for line in proc.communicate()[0].split('\n'):
+            print line
 
-    for line in proc.communicate()[0].split('\n'):
-        print line
+        if sequential:
+            gridFiles = [workdir + '/' + fileName for fileName in os.listdir(workdir) if fileName.startswith('higgsCombine' + suffix + '.HybridNew') and fileName.endswith('.root')]
+            results = hybridGrid.readGrid(gridFiles)
+            if len(results) != 0 and hybridGrid.isDecided(results.values()[0], NSIGMA):
+                print 'CLs clearly away from', hybridGrid.CLS, '- stopping'
+                break
     
     if not os.path.isdir(outputdir):
         os.mkdir(outputdir)
 
-    for fileName in os.listdir(workdir):
-        if fileName.startswith('higgsCombine' + suffix + '.HybridNew') and fileName.endswith('.root'):
+    gridFiles = sorted([fileName for fileName in os.listdir(workdir) if fileName.startswith('higgsCombine' + suffix + '.HybridNew') and fileName.endswith('.root')])
+    if len(gridFiles) == 0:
+        raise RuntimeError('No grid file produced')
+
+    if len(gridFiles) > 1:
+        # sequential chunks (one file per seed) are merged so that there is one file per index
+        fileName = '.'.join(gridFiles[0].split('.')[:-2] + ['merged', 'root'])
 
-            sys.stderr.flush()
-            sys.stderr.close()
-            sys.stderr = sys.stdout
-            os.close(2)
+        proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; hadd -f ' + fileName + ' ' + ' '.join(gridFiles), shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
 
-            err = os.open(workdir + '/errors.txt', os.O_WRONLY | os.O_CREAT)
+        for line in proc.communicate()[0].split('\n'):
+            print line
 
-            source = ROOT.TFile.Open(workdir + '/' + fileName)
-            source.Get('toys')
-            source.Get('ProcessID0')
-            source.Get('limit')
-            source.Close()
+        if proc.returncode != 0:
+            raise RuntimeError('Failed to merge grid files')
+
+    else:
+        fileName = gridFiles[0]
 
-            os.close(err)
+    sys.stderr.flush()
+    sys.stderr.close()
+    sys.stderr = sys.stdout
+    os.close(2)
 
-            with open(workdir + '/errors.txt') as errors:
-                for line in errors:
-                    if 'Error' in line:
-                        raise RuntimeError('Error found in output')
+    err = os.open(workdir + '/errors.txt', os.O_WRONLY | os.O_CREAT)
 
-            shutil.copy(workdir + '/' + fileName, outputdir + '/' + fileName)
+    source = ROOT.TFile.Open(workdir + '/' + fileName)
+    source.Get('toys')
+    source.Get('ProcessID0')
+    source.Get('limit')
+    source.Close()
+
+    os.close(err)
+
+    with open(workdir + '/errors.txt') as errors:
+        for line in errors:
+            if 'Error' in line:
+                raise RuntimeError('Error found in output')
+
+    # the index counts as done (nextIndices) only once the complete file is in place
+    shutil.copy(workdir + '/' + fileName, outputdir + '/' + fileName + '.tmp')
+    os.rename(outputdir + '/' + fileName + '.tmp', outputdir + '/' + fileName)
 
 if __name__ == '__main__':
 
-    model = sys.argv[1]
-    point = sys.argv[2]
-    index = int(sys.argv[3])
-    datadir = sys.argv[4]
-    outputdir = sys.argv[5]
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = 'Usage: clsgrid.py [-q] model point index datadir outputdir\n       clsgrid.py -a [-p precision] model point datadir outputdir')
+    parser.add_option('-a', '--adaptive', dest = 'adaptive', action = 'store_true', help = 'print the grid indices to submit next instead of running one index')
+    parser.add_option('-q', '--sequential', dest = 'sequential', action = 'store_true', help = 'throw toys in chunks and stop once CLs is clearly away from 0.05')
+    parser.add_option('-p', '--precision', dest = 'precision', type = 'float', default = 0.02, help = 'relative precision of the limits for the adaptive grid')
+
+    options, args = parser.parse_args()
+
+    if options.adaptive:
+        model, point, datadir, outputdir = args
+
+        print ' '.join(map(str, nextIndices(model, point, datadir, outputdir + '/grid_' + model + '_' + point, options.precision)))
+
+        sys.exit(0)
+
+    model = args[0]
+    point = args[1]
+    index = int(args[2])
+    datadir = args[3]
+    outputdir = args[4]
 
-    makeGrid(model, point, index, datadir, outputdir + '/grid_' + model + '_' + point)
+    makeGrid(model, point, index, datadir, outputdir + '/grid_' + model + '_' + point, sequential = options.sequential)
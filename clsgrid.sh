@@ -12,6 +12,11 @@ CWD=$HOME/src/GammaL/limits
 
 NSTEPS=100
 
+# submit only the indices chosen by the adaptive driver (rerun after each round of jobs finishes)
+ADAPTIVE=false
+# stop throwing toys at an index once its CLs values are clearly away from 0.05
+SEQUENTIAL=false
+
 if [ $INDEX ]; then
     source /afs/cern.ch/cms/cmsset_default.sh
     
@@ -20,7 +25,11 @@ if [ $INDEX ]; then
     
     cd $CWD
     
-    python clsgrid.py $MODEL $POINT $INDEX $DATADIR $OUTPUTDIR
+    if $SEQUENTIAL; then
+        python clsgrid.py -q $MODEL $POINT $INDEX $DATADIR $OUTPUTDIR
+    else
+        python clsgrid.py $MODEL $POINT $INDEX $DATADIR $OUTPUTDIR
+    fi
 else
     POINTS=""
     if [ $POINT ]; then
@@ -47,12 +56,25 @@ else
         fi
     fi
 
+    if $ADAPTIVE; then
+        source /afs/cern.ch/cms/cmsset_default.sh
+        cd $HOME/cmssw/Combine612
+        eval `scram runtime -sh`
+        cd $CWD
+    fi
+
     for POINT in $POINTS; do
         POINTNAME=${MODEL}_${POINT}
 
         mkdir $LOGDIR/$POINTNAME 2> /dev/null
 
-        for INDEX in $(seq 0 $(($NSTEPS-1))); do
+        if $ADAPTIVE; then
+            INDICES=$(python $CWD/clsgrid.py -a $MODEL $POINT $DATADIR $OUTPUTDIR | tail -n 1)
+        else
+            INDICES=$(seq 0 $(($NSTEPS-1)))
+        fi
+
+        for INDEX in $INDICES; do
             JOB=${POINTNAME}_${INDEX}
 
             [ $(ls $OUTPUTDIR/grid_$POINTNAME/higgsCombineGrid${INDEX}.* 2>/dev/null | wc -l) -ne 0 ] && continue
@@ -0,0 +1,449 @@
+import os
+import re
+import hashlib
+import numpy
+import ROOT
+
+COLUMNDIR = '/afs/cern.ch/user/y/yiiyama/work/columnCache'
+
+SUFFICES = ['', 'JESUp', 'JESDown', 'Smeared', 'SmearedUp', 'SmearedDown']
+SKIMSELECTION = '||'.join(['(mt{suffix} >= 100. && met{suffix} >= 120.)'.format(suffix = s) for s in SUFFICES])
+
+VARIABLES = [var + s for var in ['met', 'mt', 'ht'] for s in SUFFICES] + ['photon.pt[0]', 'electron.pt[0]', 'muon.pt[0]', 'mass2', 'genBoost', 'eventSigma', 'puWeight', 'effScale']
+
+def columnFileName(variable):
+    return re.sub('[^A-Za-z0-9_]', '_', variable) + '.npy'
+
+
+def remoteFingerprint(url):
+    """
+    Name, size and modification date (from the file header) of a remote ROOT file.
+    """
+
+    source = ROOT.TFile.Open(url)
+    if not source or source.IsZombie():
+        raise RuntimeError('Cannot open ' + url)
+
+    fingerprint = '%s %d %s' % (url, source.GetSize(), source.GetModificationDate().AsSQLString())
+
+    source.Close()
+
+    return fingerprint
+
+
+def fingerprint(tree, selection, variables = []):
+    """
+    Identifier of the tree content: input file names, sizes and modification times, number of entries, the skim selection and the cached variables.
+    Remote files are opened to read their size and modification date, since a regenerated sample can have the same file names and number of entries.
+    """
+
+    if tree.InheritsFrom('TChain'):
+        fileNames = [element.GetTitle() for element in tree.GetListOfFiles()]
+    else:
+        fileNames = [tree.GetCurrentFile().GetName()]
+
+    sha = hashlib.sha1(selection)
+    sha.update(' ' + ' '.join(variables))
+    for fileName in fileNames:
+        if os.path.exists(fileName):
+            stat = os.stat(fileName)
+            sha.update(' %s %d %d' % (fileName, stat.st_size, stat.st_mtime))
+        else:
+            sha.update(' ' + remoteFingerprint(fileName))
+
+    sha.update(' %d' % tree.GetEntries())
+
+    return sha.hexdigest()
+
+
+def getColumns(sample, sourceDir, selection = SKIMSELECTION):
+    """
+    Dict variable -> memory-mapped numpy array of the VARIABLES of the sample events passing the selection. The arrays are cached in COLUMNDIR/[sample name] and rebuilt when the input fingerprint changes.
+    Variables missing from the tree (e.g. genBoost in data) are left out. Elements of empty arrays (e.g. electron.pt[0] in an event without electrons) are NaN, so that any comparison with them fails as it does in a TTree::Draw selection.
+    """
+
+    cacheDir = COLUMNDIR + '/' + sample.name
+
+    sample.loadTree(sourceDir)
+    tree = sample.tree
+
+    key = fingerprint(tree, selection, VARIABLES)
+
+    try:
+        with open(cacheDir + '/fingerprint') as source:
+            cached = source.read().split()
+    except IOError:
+        cached = []
+
+    if len(cached) != 0 and cached[0] == key:
+        tree = None
+        sample.releaseTree()
+
+        return dict([(variable, numpy.load(cacheDir + '/' + columnFileName(variable), mmap_mode = 'r')) for variable in cached[1:]])
+
+    print 'Caching columns of', sample.name
+
+    try:
+        os.makedirs(cacheDir)
+    except OSError:
+        pass
+
+    # invalidate before rewriting
+    if os.path.exists(cacheDir + '/fingerprint'):
+        os.remove(cacheDir + '/fingerprint')
+
+    errorLevel = ROOT.gErrorIgnoreLevel
+    ROOT.gErrorIgnoreLevel = ROOT.kFatal
+
+    variables = []
+    for variable in VARIABLES:
+        formula = ROOT.TTreeFormula('test', variable, tree)
+        if formula.GetNdim() != 0:
+            variables.append(variable)
+        formula.Delete()
+
+    ROOT.gErrorIgnoreLevel = errorLevel
+
+    expressions = []
+    for variable in variables:
+        if '[' in variable:
+            expressions.append('Alt$(' + variable + ', sqrt(-1.))')
+        else:
+            expressions.append(variable)
+
+    tree.SetEstimate(tree.GetEntries() + 1)
+    nEntries = tree.Draw(':'.join(expressions), selection, 'goff')
+
+    for iVar, variable in enumerate(variables):
+        buf = tree.GetVal(iVar)
+        buf.SetSize(nEntries)
+        with open(cacheDir + '/' + columnFileName(variable), 'wb') as output:
+            numpy.save(output, numpy.frombuffer(buf, dtype = numpy.float64, count = nEntries))
+
+    tree = None
+    sample.releaseTree()
+
+    with open(cacheDir + '/fingerprint', 'w') as output:
+        output.write(' '.join([key] + variables) + '\n')
+
+    return dict([(variable, numpy.load(cacheDir + '/' + columnFileName(variable), mmap_mode = 'r')) for variable in variables])
+
+
+TOKEN = re.compile(r'\s*(?:((?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)|([A-Za-z_][A-Za-z0-9_.:$]*(?:\[[0-9]+\])?)|(&&|\|\||==|!=|<=|>=|[-+*/<>!(),]))')
+
+FUNCTIONS = {
+    'abs': numpy.abs,
+    'fabs': numpy.abs,
+    'TMath::Abs': numpy.abs,
+    'sqrt': numpy.sqrt,
+    'TMath::Sqrt': numpy.sqrt,
+    'exp': numpy.exp,
+    'log': numpy.log
+}
+
+class Lookup(object):
+    """
+    Histogram-like function of one variable given by bin edges and contents. Values outside the edges take the first or last bin content; NaN (missing array element) gives 0.
+    """
+
+    def __init__(self, edges, contents):
+        self.edges = numpy.array(edges, dtype = numpy.float64)
+        self.contents = numpy.array(contents, dtype = numpy.float64)
+
+    def __call__(self, x):
+        x = numpy.asarray(x, dtype = numpy.float64)
+        # index of the bin whose low edge is the last one <= x, counting only the inner edges (clamps under- and overflow)
+        iBin = numpy.searchsorted(self.edges[1:-1], x, side = 'right')
+        return numpy.where(numpy.isnan(x), 0., self.contents[iBin])
+
+    def expression(self, arg):
+        """
+        Equivalent TTreeFormula expression (sum of bin conditions times contents), giving the same values as __call__ including 0 for a missing array element.
+        """
+
+        # a missing array element would otherwise skip the entry in all columns of a multi-column TTree::Draw
+        arg = 'Alt$(' + arg + ', sqrt(-1.))'
+
+        nBins = len(self.contents)
+
+        terms = []
+        for iBin in range(nBins):
+            conditions = []
+            if iBin != 0:
+                conditions.append('%s >= %.17g' % (arg, self.edges[iBin]))
+            if iBin != nBins - 1:
+                conditions.append('%s < %.17g' % (arg, self.edges[iBin + 1]))
+
+            if len(conditions) == 0:
+                # single bin: NaN still gives 0, as in __call__
+                conditions.append('%s == %s' % (arg, arg))
+
+            terms.append('(%s) * %.17g' % (' && '.join(conditions), self.contents[iBin]))
+
+        return '(' + ' + '.join(terms) + ')'
+
+
+LOOKUPS = {} # function name -> Lookup, usable in expressions as name(variable)
+
+BINARY = {
+    '*': numpy.multiply,
+    '/': numpy.divide,
+    '+': numpy.add,
+    '-': numpy.subtract,
+    '<': numpy.less,
+    '>': numpy.greater,
+    '<=': numpy.less_equal,
+    '>=': numpy.greater_equal,
+    '==': numpy.equal,
+    '!=': numpy.not_equal
+}
+
+# binary operators by increasing precedence; && and || are handled as flattened n-ary nodes
+PRECEDENCE = [['||'], ['&&'], ['<', '>', '<=', '>=', '==', '!='], ['+', '-'], ['*', '/']]
+
+def tokenize(expr):
+    """
+    List of (kind, value, start, end) with kind one of num, name and op.
+    """
+
+    tokens = []
+    pos = 0
+    while expr[pos:].strip():
+        matches = TOKEN.match(expr, pos)
+        if not matches:
+            raise RuntimeError('Cannot parse ' + expr[pos:])
+
+        number, name, op = matches.groups()
+        if number is not None:
+            tokens.append(('num', float(number), matches.start(1), matches.end(1)))
+        elif name is not None:
+            tokens.append(('name', name, matches.start(2), matches.end(2)))
+        else:
+            tokens.append(('op', op, matches.start(3), matches.end(3)))
+
+        pos = matches.end()
+
+    return tokens
+
+
+def renameVariables(expr, mapping):
+    """
+    Expression with the variables (whole identifiers, wherever they appear) renamed according to mapping. Used for systematic variations, e.g. {'met': 'metJESUp'}.
+    """
+
+    result = ''
+    pos = 0
+    for kind, value, start, end in tokenize(expr):
+        if kind == 'name' and value in mapping:
+            result += expr[pos:start] + mapping[value]
+            pos = end
+
+    return result + expr[pos:]
+
+
+def expandLookups(expr):
+    """
+    Expression with the LOOKUPS calls replaced by their TTreeFormula equivalents, for use in TTree::Draw.
+    """
+
+    tokens = tokenize(expr)
+
+    result = ''
+    pos = 0
+    iTok = 0
+    while iTok < len(tokens):
+        kind, value, start, end = tokens[iTok]
+        if kind == 'name' and value in LOOKUPS and iTok + 1 < len(tokens) and tokens[iTok + 1][:2] == ('op', '('):
+            depth = 0
+            for iClose in range(iTok + 1, len(tokens)):
+                if tokens[iClose][:2] == ('op', '('):
+                    depth += 1
+                elif tokens[iClose][:2] == ('op', ')'):
+                    depth -= 1
+                    if depth == 0: break
+            else:
+                raise RuntimeError('Unbalanced parentheses in ' + expr)
+
+            arg = expandLookups(expr[tokens[iTok + 1][3]:tokens[iClose][2]])
+            result += expr[pos:start] + LOOKUPS[value].expression(arg)
+            pos = tokens[iClose][3]
+            iTok = iClose
+
+        iTok += 1
+
+    return result + expr[pos:]
+
+
+parsed = {}
+
+def parse(expr):
+    """
+    Syntax tree of a TTreeFormula-style expression (the subset used in the cuts and weights of this package) as nested tuples. Chains of && and || are flattened into nodes with sorted operands, so that e.g. the cuts of different channels share their atomic predicates.
+    """
+
+    if expr in parsed:
+        return parsed[expr]
+
+    tokens = tokenize(expr)
+    pos = [0]
+
+    def peek():
+        if pos[0] == len(tokens): return (None, None)
+        return tokens[pos[0]][:2]
+
+    def take(op = None):
+        token = peek()
+        if op is not None and token != ('op', op):
+            raise RuntimeError('Expected ' + op + ' in ' + expr)
+        pos[0] += 1
+        return token
+
+    def binary(level):
+        if level == len(PRECEDENCE):
+            return unary()
+
+        ops = PRECEDENCE[level]
+
+        node = binary(level + 1)
+        operands = [node]
+        while peek()[0] == 'op' and peek()[1] in ops:
+            op = take()[1]
+            rhs = binary(level + 1)
+            if op in ['&&', '||']:
+                operands.append(rhs)
+            else:
+                node = (op, node, rhs)
+
+        if len(operands) == 1:
+            return node
+
+        flat = []
+        for operand in operands:
+            if operand[0] == ops[0]:
+                flat += operand[1]
+            else:
+                flat.append(operand)
+
+        return (ops[0], tuple(sorted(set(flat))))
+
+    def unary():
+        token = peek()
+        if token == ('op', '-'):
+            take()
+            return ('neg', unary())
+        elif token == ('op', '!'):
+            take()
+            return ('!', unary())
+        else:
+            return primary()
+
+    def primary():
+        kind, value = take()
+        if kind == 'num':
+            return ('num', value)
+
+        elif kind == 'name':
+            if peek() == ('op', '(') and value == 'Alt$':
+                # missing array elements are already NaN in the columns
+                take('(')
+                arg = binary(0)
+                take(',')
+                alt = binary(0)
+                take(')')
+                return ('alt', arg, alt)
+
+            if peek() == ('op', '('):
+                if value not in FUNCTIONS and value not in LOOKUPS:
+                    raise RuntimeError('Unknown function ' + value + ' in ' + expr)
+                take('(')
+                arg = binary(0)
+                take(')')
+                return ('func', value, arg)
+
+            return ('var', value)
+
+        elif (kind, value) == ('op', '('):
+            node = binary(0)
+            take(')')
+            return node
+
+        raise RuntimeError('Unexpected ' + str(value) + ' in ' + expr)
+
+    tree = binary(0)
+    if pos[0] != len(tokens):
+        raise RuntimeError('Trailing tokens in ' + expr)
+
+    parsed[expr] = tree
+
+    return tree
+
+
+class Evaluator(object):
+    """
+    Evaluates expressions on one set of column arrays. The comparison (e.g. mt >= 100.) and function nodes are memoized, so the atomic predicates shared by all channels and variations are computed once and combining them into channel masks is cheap.
+    Comparisons are kept as bool arrays; &&, || and arithmetic are recomputed from them on every call so that the memo does not grow by one sample-length array per channel.
+    Values are returned as floats (booleans as 0/1), as in TTreeFormula.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.values = {}
+
+    def __call__(self, expr):
+        # NaN (missing array element) compares false without warnings
+        with numpy.errstate(invalid = 'ignore'):
+            return numpy.asarray(self.evaluate(parse(expr))).astype(numpy.float64)
+
+    def number(self, node):
+        value = self.evaluate(node)
+        if numpy.asarray(value).dtype == numpy.bool_:
+            value = numpy.asarray(value).astype(numpy.float64)
+
+        return value
+
+    def evaluate(self, node):
+        if node in self.values:
+            return self.values[node]
+
+        op = node[0]
+
+        if op == 'num':
+            return node[1]
+        elif op == 'var':
+            if node[1] not in self.columns:
+                raise RuntimeError('Column ' + node[1] + ' not available')
+            return self.columns[node[1]]
+        elif op == 'func':
+            if node[1] in LOOKUPS:
+                value = LOOKUPS[node[1]](self.number(node[2]))
+            else:
+                value = FUNCTIONS[node[1]](self.number(node[2]))
+        elif op == 'alt':
+            value = self.number(node[1])
+            value = numpy.where(numpy.isnan(value), self.number(node[2]), value)
+        elif op == 'neg':
+            value = -self.number(node[1])
+        elif op == '!':
+            value = numpy.asarray(self.evaluate(node[1])) == 0.
+        elif op in ['&&', '||']:
+            combine = numpy.logical_and if op == '&&' else numpy.logical_or
+            value = numpy.asarray(self.evaluate(node[1][0])) != 0.
+            for operand in node[1][1:]:
+                value = combine(value, numpy.asarray(self.evaluate(operand)) != 0.)
+        elif op in PRECEDENCE[2]:
+            value = numpy.asarray(BINARY[op](self.number(node[1]), self.number(node[2])))
+        else:
+            value = BINARY[op](self.number(node[1]), self.number(node[2]))
+
+        if op == 'func' or op in PRECEDENCE[2]:
+            self.values[node] = value
+
+        return value
+
+
+def evaluate(expr, columns):
+    """
+    Value of a TTreeFormula-style expression on the column arrays (one-off; use an Evaluator to share sub-expressions between many expressions).
+    """
+
+    return Evaluator(columns)(expr)
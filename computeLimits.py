@@ -6,17 +6,53 @@ import math
 import subprocess
 import array
 import re
+import random
 import pickle
+import hashlib
+import fnmatch
+import multiprocessing
+import numpy
 import ROOT
 
 ROOT.gROOT.SetBatch(True)
 
 import datacard
+import asymptoticCLs
+import hybridGrid
+import signalStore
+from scheduler import Scheduler
 
 SETENV = 'cd /afs/cern.ch/user/y/yiiyama/cmssw/Combine612; eval `scram runtime -sh`;'
 XSECDIR = '/afs/cern.ch/user/y/yiiyama/output/GammaL/limits/xsecs'
 FULLCLS = False
 FORCEPROF = False
+NATIVE = False
+MAXPROCS = 0 # 0 -> number of CPUs
+ADAPTIVEGRID = False
+GRIDPRECISION = 0.02
+MAXGRIDROUNDS = 10
+SEQUENTIALTOYS = False
+TOYCHUNK = 200
+MAXTOYS = 1000
+TOYNSIGMA = 3.
+CACHEDIR = '' # limit result cache; disabled if empty
+FIXEDSEEDS = False
+RESUME = False
+
+# inputs for computePoint, set in __main__
+GRIDFILE = ''
+CHANNELS = {}
+SIGNALS = {}
+OUTPUTDIR = ''
+
+def bufferArray(buf, size):
+    """
+    Wrap a TTree::Draw output buffer (GetV1 etc.) as a numpy array without copying. Valid only until the next Draw on the tree.
+    """
+
+    buf.SetSize(size)
+    return numpy.frombuffer(buf, dtype = numpy.float64, count = size)
+
 
 def getLimits(fileName, vLimits, calculate = False):
     """
@@ -28,24 +64,29 @@ def getLimits(fileName, vLimits, calculate = False):
 
     resTree.SetEstimate(resTree.GetEntries() + 1)
     nEntries = resTree.Draw('quantileExpected:limit:iToy', 'limit > 0.', 'goff') # condition to avoid nans
-    quantiles = resTree.GetV1()
-    rvalues = resTree.GetV2()
-    toyIndices = resTree.GetV3()
+    quantiles = bufferArray(resTree.GetV1(), nEntries)
+    rvalues = bufferArray(resTree.GetV2(), nEntries)
+    toyIndices = bufferArray(resTree.GetV3(), nEntries)
 
     if calculate:
-        rArr = [rvalues[i] for i in range(nEntries) if toyIndices[i] > 0]
+        rArr = numpy.sort(rvalues[toyIndices > 0])
 
-        rArr.sort()
-
-        # remove outliers
+        # remove outliers: histogram the r values and cut above the first pair of empty bins
         binwidth = (rArr[int(0.5 * nEntries)] - rArr[0]) / 5.
-        hist = ROOT.TH1D('hist', 'r value distribution', int((rArr[-1] - rArr[0] + 1.) / binwidth) + 1, rArr[0], rArr[-1] + 1.)
-        for r in rArr: hist.Fill(r)
+        nBins = int((rArr[-1] - rArr[0] + 1.) / binwidth) + 1
+        xmin = rArr[0]
+        xmax = rArr[-1] + 1.
+
+        # same binning arithmetic as TAxis::FindBin; index nBins + 1 is the (empty) overflow
+        contents = numpy.bincount(1 + (nBins * (rArr - xmin) / (xmax - xmin)).astype(int), minlength = nBins + 2)
 
-        for iX in range(1, hist.GetNbinsX() + 1):
-            if hist.GetBinContent(iX) == 0. and hist.GetBinContent(iX + 1) == 0.: break
+        empty = (contents[1:nBins + 1] == 0) & (contents[2:nBins + 2] == 0)
+        if numpy.any(empty):
+            iX = 1 + numpy.argmax(empty)
+        else:
+            iX = nBins
 
-        while rArr[-1] > hist.GetXaxis().GetBinLowEdge(iX): rArr.pop()
+        rArr = rArr[:numpy.searchsorted(rArr, xmin + (iX - 1) * ((xmax - xmin) / nBins), side = 'right')]
 
         n = len(rArr)
 
@@ -55,28 +96,28 @@ def getLimits(fileName, vLimits, calculate = False):
         vLimits['p1s'][0] = rArr[int(0.84 * n)]
         vLimits['p2s'][0] = rArr[int(0.975 * n)]
 
-        try:
-            obsIndex = next(i for i in range(nEntries) if toyIndices[i] == 0)
-            vLimits['obs'][0] = rvalues[obsIndex]
-        except:
+        obsIndices = numpy.flatnonzero(toyIndices == 0)
+        if len(obsIndices) == 0:
             return False
 
+        vLimits['obs'][0] = rvalues[obsIndices[0]]
+
         return True
 
     else:
+        quantNames = ['obs', 'm2s', 'm1s', 'med', 'p1s', 'p2s']
+        categories = numpy.digitize(quantiles, [0., 0.03, 0.2, 0.6, 0.9])
+
         limSet = set()
-        
-        for iEntry in range(nEntries):
-            if quantiles[iEntry] < 0.: quant = 'obs'
-            elif quantiles[iEntry] < 0.03: quant = 'm2s'
-            elif quantiles[iEntry] < 0.2: quant = 'm1s'
-            elif quantiles[iEntry] < 0.6: quant = 'med'
-            elif quantiles[iEntry] < 0.9: quant = 'p1s'
-            else: quant = 'p2s'
+
+        for iQ, quant in enumerate(quantNames):
+            indices = numpy.flatnonzero(categories == iQ)
+            if len(indices) == 0: continue
 
             limSet.add(quant)
-            
-            vLimits[quant][0] = rvalues[iEntry]
+
+            # last entry wins, as in combine output order
+            vLimits[quant][0] = rvalues[indices[-1]]
 
         return len(limSet) == 6
 
@@ -89,12 +130,204 @@ def writeLog(header, content = ''):
     sys.stdout.write(content + '\n')
 
 
+def seedFor(card, tag):
+    """
+    Combine seed for the job identified by tag. Random (-1) unless FIXEDSEEDS, in which case the seed is derived from the card content so that toy-based results are reproducible.
+    """
+
+    if not FIXEDSEEDS:
+        return '-1'
+
+    with open(card) as source:
+        digest = hashlib.sha1(source.read() + tag).hexdigest()
+
+    return str(int(digest[:7], 16) + 1)
+
+
+def fileDigest(path):
+    """
+    SHA-1 of the file content (read in blocks; grid files can be large).
+    """
+
+    sha = hashlib.sha1()
+    with open(path, 'rb') as source:
+        while True:
+            block = source.read(1 << 20)
+            if not block: break
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def cachePath(card, method, methodOptions):
+    """
+    Location of the cached result for (card text, method, method options) in CACHEDIR.
+    """
+
+    with open(card) as source:
+        key = hashlib.sha1(source.read() + '\0' + method + '\0' + methodOptions).hexdigest()
+
+    return CACHEDIR + '/' + key[:2] + '/' + key + '.pkl'
+
+
+def cached(card, method, methodOptions, vLimits, calculate):
+    """
+    Return True and fill vLimits from the cache if the result of method for this card and options is known. Otherwise call calculate() and store the limits if it succeeds.
+    """
+
+    if not CACHEDIR:
+        return calculate()
+
+    path = cachePath(card, method, methodOptions)
+
+    if os.path.exists(path):
+        with open(path, 'rb') as source:
+            limits = pickle.load(source)
+
+        for p, val in limits.items():
+            vLimits[p][0] = val
+
+        writeLog('Using cached ' + method + ' result', path)
+        return True
+
+    if not calculate():
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+
+    # write and rename so that concurrent jobs never see a partial file
+    tmpPath = path + '.' + str(os.getpid())
+    with open(tmpPath, 'wb') as output:
+        pickle.dump(dict([(p, val[0]) for p, val in vLimits.items()]), output)
+
+    os.rename(tmpPath, path)
+
+    return True
+
+
+def readStage(ckptdir, stage):
+    """
+    Completion marker of a stage in the checkpoint directory. Returns (done, limits).
+    """
+
+    if not RESUME or not os.path.exists(ckptdir + '/' + stage + '.done'):
+        return False, None
+
+    with open(ckptdir + '/' + stage + '.done', 'rb') as source:
+        return True, pickle.load(source)
+
+
+def writeStage(ckptdir, stage, limits):
+    tmpPath = ckptdir + '/' + stage + '.done.tmp'
+    with open(tmpPath, 'wb') as output:
+        pickle.dump(limits, output)
+
+    os.rename(tmpPath, ckptdir + '/' + stage + '.done')
+
+
+def checkpointed(ckptdir, stage, vLimits, calculate):
+    """
+    Run calculate() unless the stage is marked as completed in ckptdir (RESUME only), in which case the recorded limits are filled into vLimits. Only successful stages are recorded, so that a failed stage is retried on resume.
+    """
+
+    done, limits = readStage(ckptdir, stage)
+
+    # limits is None in checkpoints of failed stages written by older versions
+    if done and limits is not None:
+        writeLog('Skipping completed stage ' + stage)
+
+        for p, val in limits.items():
+            vLimits[p][0] = val
+
+        return True
+
+    if calculate():
+        writeStage(ckptdir, stage, dict([(p, val[0]) for p, val in vLimits.items()]))
+        return True
+    else:
+        return False
+
+
+def saveGridFiles(workdir, ckptdir):
+    """
+    Copy the finished (validated) grid toy files in workdir to the checkpoint directory.
+    """
+
+    if not ckptdir: return
+
+    for fileName in os.listdir(workdir):
+        if not fileName.startswith('higgsCombineGrid.HybridNew.') or not fileName.endswith('.root'): continue
+        if os.path.exists(ckptdir + '/' + fileName): continue
+        if not hybridGrid.isValidGridFile(workdir + '/' + fileName): continue
+
+        shutil.copyfile(workdir + '/' + fileName, ckptdir + '/' + fileName + '.tmp')
+        os.rename(ckptdir + '/' + fileName + '.tmp', ckptdir + '/' + fileName)
+
+
+def markGridDone(workdir, ckptdir, rval, seeds):
+    """
+    Record that the toys of the r-value are complete: [workdir]/Grid_[rval].done lists its grid files, identified by the seeds of its combine jobs. The files and then the marker are saved to ckptdir.
+    """
+
+    fileNames = [fileName for fileName in os.listdir(workdir) if fileName.startswith('higgsCombineGrid.HybridNew.') and fileName.endswith('.root') and fileName.split('.')[-2] in seeds]
+
+    marker = 'Grid_' + rval + '.done'
+
+    with open(workdir + '/' + marker + '.tmp', 'wb') as output:
+        pickle.dump(fileNames, output)
+    os.rename(workdir + '/' + marker + '.tmp', workdir + '/' + marker)
+
+    if not ckptdir: return
+
+    saveGridFiles(workdir, ckptdir)
+
+    shutil.copyfile(workdir + '/' + marker, ckptdir + '/' + marker + '.tmp')
+    os.rename(ckptdir + '/' + marker + '.tmp', ckptdir + '/' + marker)
+
+
+def doneGridValues(workdir):
+    return [float(fileName[5:-5]) for fileName in os.listdir(workdir) if fileName.startswith('Grid_') and fileName.endswith('.done')]
+
+
+def restoreGridFiles(workdir, ckptdir):
+    """
+    Copy the grid toy files of the r-values completed by an interrupted job (markGridDone) back to workdir. r-values with missing or invalid files, and files of r-values that were not completed, are discarded.
+    """
+
+    keep = set()
+
+    for marker in os.listdir(ckptdir):
+        if not marker.startswith('Grid_') or not marker.endswith('.done'): continue
+
+        with open(ckptdir + '/' + marker, 'rb') as source:
+            fileNames = pickle.load(source)
+
+        if not all(os.path.exists(ckptdir + '/' + fileName) and hybridGrid.isValidGridFile(ckptdir + '/' + fileName) for fileName in fileNames):
+            writeLog('Discarding incomplete grid point', marker)
+            os.remove(ckptdir + '/' + marker)
+            continue
+
+        for fileName in fileNames:
+            shutil.copyfile(ckptdir + '/' + fileName, workdir + '/' + fileName)
+            keep.add(fileName)
+
+        shutil.copyfile(ckptdir + '/' + marker, workdir + '/' + marker)
+
+    for fileName in os.listdir(ckptdir):
+        if fileName.startswith('higgsCombineGrid.HybridNew.') and fileName.endswith('.root') and fileName not in keep:
+            writeLog('Discarding grid file of an incomplete point', fileName)
+            os.remove(ckptdir + '/' + fileName)
+
+
 def asymptotic(card, workdir, vLimits):
     """
     Run combine in asymptotic mode and return the resulting expected limits in the form of python dict (using getLimits)
     """
 
-    proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; combine ' + card + ' -M Asymptotic -s -1 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; combine ' + card + ' -M Asymptotic -s ' + seedFor(card, 'Asymptotic') + ' 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
     output = proc.communicate()[0]
 
     writeLog('Asymptotic', output)
@@ -126,106 +359,143 @@ def profileLikelihood(card, workdir, vLimits):
 
     writeLog('ProfileLikelihood Expected')
 
-    procs = []
+    scheduler = Scheduler(MAXPROCS, report = writeLog)
+
     seeds = [str(i) for i in range(1, 9)]
-    while True:
-        for seed, proc in procs:
-            if proc.poll() is None: continue
+    for seed in seeds:
+        scheduler.add('Proc ' + seed, SETENV + ' cd ' + workdir + '; combine ' + card + ' -M ProfileLikelihood -t 20 -s ' + seed + ' 2>&1', workdir + '/ProfileLikelihood_' + seed + '.log')
 
-            output = proc.communicate()[0]
+    scheduler.add('ProfileLikelihood Observed', SETENV + ' cd ' + workdir + '; combine ' + card + ' -n Obs -M ProfileLikelihood -s ' + seedFor(card, 'ProfileLikelihood Observed') + ' 2>&1', workdir + '/ProfileLikelihood_Obs.log')
 
-            writeLog('Proc ' + seed, output)
+    scheduler.add('Merge ProfileLikelihood', SETENV + ' cd ' + workdir + '; hadd ProfileLikelihood.root higgsCombine*.ProfileLikelihood.*.root 2>&1', workdir + '/ProfileLikelihood_merge.log', after = ['Proc ' + seed for seed in seeds] + ['ProfileLikelihood Observed'])
 
-            procs.remove((seed, proc))
-        
-        if len(procs) == 0 and len(seeds) == 0: break
+    scheduler.run()
 
-        if len(procs) >= 4: continue
+    return getLimits(workdir + '/ProfileLikelihood.root', vLimits, calculate = True)
 
-        try:
-            seed = seeds.pop()
-        except IndexError:
-            continue
 
-        proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; combine ' + card + ' -M ProfileLikelihood -t 20 -s ' + seed + ' 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+def runGridPoints(rvalues, card, workdir, ckptdir = ''):
+    """
+    Throw toys at each of the given r-values (combine HybridNew --singlePoint jobs). With SEQUENTIALTOYS, toys are thrown in chunks of TOYCHUNK and a point stops as soon as all its CLs values are clearly on one side of 0.05.
+    r-values marked as completed in workdir (markGridDone; earlier rounds or restored from a checkpoint) are skipped. Finished toy files are saved to ckptdir if given.
+    """
 
-        procs.append((seed, proc))
+    doneValues = doneGridValues(workdir)
+    rvalues = [rvalue for rvalue in rvalues if not any(abs(rvalue - done) < 1.e-4 * rvalue for done in doneValues)]
 
-    proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; combine ' + card + ' -n Obs -M ProfileLikelihood -s -1 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-    output = proc.communicate()[0]
+    scheduler = Scheduler(MAXPROCS, report = writeLog)
 
-    writeLog('ProfileLikelihood Observed', output)
+    def gridPointFinished(rval, seed, returncode):
+        if returncode == 0:
+            markGridDone(workdir, ckptdir, rval, [seed])
 
-    proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; hadd ProfileLikelihood.root higgsCombine*.ProfileLikelihood.*.root 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-    output = proc.communicate()[0]
+    if not SEQUENTIALTOYS:
+        for rvalue in rvalues:
+            rval = '%.5g' % rvalue
+            # explicit seed so that the output file name identifies the r-value
+            seed = seedFor(card, 'Grid ' + rval)
+            if seed == '-1':
+                seed = str(random.randint(1, 1000000000))
 
-    writeLog('Merge ProfileLikelihood', output)
+            scheduler.add('Grid ' + rval, SETENV + ' cd ' + workdir + '; combine ' + card + ' -n Grid -M HybridNew -s ' + seed + ' --freq --clsAcc 0 -T 1000 -i 1 --saveToys --saveHybridResult --singlePoint ' + rval + ' 2>&1', workdir + '/Grid_' + rval + '.log', callback = lambda returncode, rval = rval, seed = seed: gridPointFinished(rval, seed, returncode))
 
-    return getLimits(workdir + '/ProfileLikelihood.root', vLimits, calculate = True)
+        scheduler.run()
+        return
 
+    seeds = dict([('%.5g' % rvalue, []) for rvalue in rvalues])
 
-def makeGrid(bounds, card, workdir):
-    """
-    Generate toys for 100 r-values (signal strengths; mu-value) between the given bounds. To be used for frequentist expected limits. Resulting ROOT files are merged with hadd into [workdir]/HybridGrid.root
-    """
+    def addChunk(rval):
+        seed = seedFor(card, 'Grid ' + rval + ' chunk ' + str(len(seeds[rval]) + 1))
+        if seed == '-1':
+            seed = str(random.randint(1, 1000000000))
+        seeds[rval].append(seed)
 
-    nSteps = 100
-    rvalues = [bounds[0] + (bounds[1] - bounds[0]) / nSteps * i for i in range(nSteps)]
-    procs = []
-    while True:
-        for rval, proc in procs:
-            if proc.poll() is None: continue
+        name = 'Grid ' + rval + ' chunk ' + str(len(seeds[rval]))
+        scheduler.add(name, SETENV + ' cd ' + workdir + '; combine ' + card + ' -n Grid -M HybridNew -s ' + seed + ' --freq --clsAcc 0 -T ' + str(TOYCHUNK) + ' -i 1 --saveToys --saveHybridResult --singlePoint ' + rval + ' 2>&1', workdir + '/Grid_' + rval + '_' + seed + '.log', callback = lambda returncode: checkChunk(rval))
 
-            output = proc.communicate()[0]
+    def checkChunk(rval):
+        saveGridFiles(workdir, ckptdir)
 
-            writeLog('Grid ' + rval, output)
+        if len(seeds[rval]) * TOYCHUNK >= MAXTOYS:
+            markGridDone(workdir, ckptdir, rval, seeds[rval])
+            return
 
-            procs.remove((rval, proc))
+        gridFiles = [workdir + '/' + fileName for fileName in os.listdir(workdir) if fileName.startswith('higgsCombineGrid.HybridNew.') and fileName.split('.')[-2] in seeds[rval]]
+        results = hybridGrid.readGrid(gridFiles)
 
-        if len(procs) == 0 and len(rvalues) == 0: break
+        if len(results) != 0 and hybridGrid.isDecided(results.values()[0], TOYNSIGMA):
+            writeLog('Grid ' + rval, 'Stopping after ' + str(len(seeds[rval]) * TOYCHUNK) + ' toys')
+            markGridDone(workdir, ckptdir, rval, seeds[rval])
+            return
 
-        if len(procs) >= 4: continue
+        addChunk(rval)
 
-        try:
-            rval = '%.4f' % rvalues.pop()
-        except IndexError:
-            continue
+    for rval in seeds.keys():
+        addChunk(rval)
 
-        proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; combine ' + card + ' -n Grid -M HybridNew -s -1 --freq --clsAcc 0 -T 1000 -i 1 --saveToys --saveHybridResult --singlePoint ' + rval, shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+    scheduler.run()
 
-        procs.append((rval, proc))
+
+def makeGrid(bounds, card, workdir, ckptdir = ''):
+    """
+    Generate toys for r-values (signal strengths; mu-value) around the given bounds. To be used for frequentist expected limits. Resulting ROOT files are merged with hadd into [workdir]/HybridGrid.root, whose path is returned.
+    By default 100 r-values are spaced uniformly between the bounds. With ADAPTIVEGRID, a coarse log-spaced grid between 0.7 x lower and 1.5 x upper bound is refined around the CLs = 0.05 crossings until they are known to GRIDPRECISION.
+    """
+
+    if ADAPTIVEGRID:
+        lnrlow = math.log(bounds[0] * 0.7)
+        lnrhigh = math.log(bounds[1] * 1.5)
+        nStart = 8
+        rvalues = [math.exp(lnrlow + (lnrhigh - lnrlow) / (nStart - 1) * i) for i in range(nStart)]
+
+        for iRound in range(MAXGRIDROUNDS):
+            runGridPoints(rvalues, card, workdir, ckptdir)
+
+            gridFiles = [workdir + '/' + fileName for fileName in os.listdir(workdir) if fileName.startswith('higgsCombineGrid.HybridNew.')]
+            rvalues = hybridGrid.nextRValues(hybridGrid.clsTable(hybridGrid.readGrid(gridFiles)), GRIDPRECISION)
+
+            writeLog('Grid refinement round ' + str(iRound), 'Next r values: ' + ' '.join(['%.5g' % r for r in rvalues]))
+
+            if len(rvalues) == 0: break
+
+    else:
+        nSteps = 100
+        rvalues = [bounds[0] + (bounds[1] - bounds[0]) / nSteps * i for i in range(nSteps)]
+
+        runGridPoints(rvalues, card, workdir, ckptdir)
 
     writeLog('Merge Grid')
 
     proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; hadd HybridGrid.root higgsCombineGrid.HybridNew.*.root 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
     proc.communicate()
 
+    return workdir + '/HybridGrid.root'
+
 
 def fullCLs(card, workdir, vLimits, gridfile):
     """
     Run combine in HybridNew mode and return the resulting expected limits in the form of python dict (using getLimits)    
     """
 
-    proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; combine ' + card + ' -n FullCLs -M HybridNew -s -1 --freq --plot plots.root --grid ' + gridfile + ' --fullGrid 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-    output = proc.communicate()[0]
+    scheduler = Scheduler(MAXPROCS, report = writeLog)
 
-    writeLog('Observed', output)
+    scheduler.add('Observed', SETENV + ' cd ' + workdir + '; combine ' + card + ' -n FullCLsObs -M HybridNew -s ' + seedFor(card, 'FullCLs Observed') + ' --freq --plot plots.root --grid ' + gridfile + ' --fullGrid 2>&1', workdir + '/FullCLs_obs.log')
 
-    for quant in ['0.025', '0.16', '0.5', '0.84', '0.975']:
-        proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; combine ' + card + ' -n FullCLs -M HybridNew -s -1 --freq --grid ' + gridfile + ' --expectedFromGrid ' + quant + ' --fullGrid 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-        output = proc.communicate()[0]
-        
-        writeLog('Expected ' + quant, output)
+    quants = hybridGrid.QUANTILES
+    for quant in quants:
+        scheduler.add('Expected ' + quant, SETENV + ' cd ' + workdir + '; combine ' + card + ' -n FullCLsExp' + quant + ' -M HybridNew -s ' + seedFor(card, 'FullCLs Expected ' + quant) + ' --freq --grid ' + gridfile + ' --expectedFromGrid ' + quant + ' --fullGrid 2>&1', workdir + '/FullCLs_' + quant + '.log')
 
-    writeLog('Merge FullCLs')
+    scheduler.add('Merge FullCLs', SETENV + ' cd ' + workdir + '; hadd HybridFullCLs.root higgsCombineFullCLs*.HybridNew.*.root 2>&1', workdir + '/FullCLs_merge.log', after = ['Observed'] + ['Expected ' + quant for quant in quants])
 
-    proc = subprocess.Popen(SETENV + ' cd ' + workdir + '; hadd HybridFullCLs.root higgsCombineFullCLs.HybridNew.*.root 2>&1', shell = True, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-    proc.communicate()
+    scheduler.run()
 
     return getLimits(workdir + '/HybridFullCLs.root', vLimits)
 
 
 def computeLimits(pointName, channels, outputdir, gridfile = ''):
+    """
+    Write the datacard for the point and compute its limits with the configured methods into [outputdir]/[pointName].root. Returns False if no method succeeded.
+    """
 
     try:
         workdir = os.environ['TMPDIR'] + '/' + pointName
@@ -241,6 +511,20 @@ def computeLimits(pointName, channels, outputdir, gridfile = ''):
     except OSError:
         pass
 
+    # Completed stages and finished grid toys are recorded in the output directory so that a killed job can be resumed
+
+    ckptdir = outputdir + '/' + pointName + '_ckpt'
+
+    if not RESUME:
+        try:
+            shutil.rmtree(ckptdir)
+        except OSError:
+            pass
+    try:
+        os.makedirs(ckptdir)
+    except OSError:
+        pass
+
     # Results are written into a tree (to be merged with calculations for all other signal points)
 
     limitPoints = ['obs', 'med', 'm2s', 'm1s', 'p1s', 'p2s']
@@ -262,25 +546,43 @@ def computeLimits(pointName, channels, outputdir, gridfile = ''):
     datacard.writeDataCard(channels, cardPath)
 
     if not (FULLCLS and gridfile):
-        writeLog('Calculating asymptotic limits')
-        method = 'asymptotic'
-    
-        converged = asymptotic(cardPath, workdir, vLimits)
-    
-        if converged:
-            for iC in range(len(method)):
-                vMethod[iC] = method[iC]
-                vMethod[iC + 1] = '\0'
-                
-            limitTree.Fill()
-        else:
-            print 'Asymptotic method did not converge.'
+        converged = False
+
+        if NATIVE:
+            writeLog('Calculating asymptotic limits in process')
+            method = 'nativeAsymptotic'
+
+            converged = checkpointed(ckptdir, method, vLimits, lambda: cached(cardPath, method, 'CLs=%g' % asymptoticCLs.CLS, vLimits, lambda: asymptoticCLs.asymptotic(channels, vLimits)))
+
+            if converged:
+                for iC in range(len(method)):
+                    vMethod[iC] = method[iC]
+                    vMethod[iC + 1] = '\0'
+
+                limitTree.Fill()
+            else:
+                print 'Native asymptotic calculation did not converge.'
+
+        if not converged:
+            writeLog('Calculating asymptotic limits')
+            method = 'asymptotic'
+        
+            converged = checkpointed(ckptdir, method, vLimits, lambda: cached(cardPath, method, '-M Asymptotic', vLimits, lambda: asymptotic(cardPath, workdir, vLimits)))
+        
+            if converged:
+                for iC in range(len(method)):
+                    vMethod[iC] = method[iC]
+                    vMethod[iC + 1] = '\0'
+                    
+                limitTree.Fill()
+            else:
+                print 'Asymptotic method did not converge.'
     
         if FORCEPROF or not converged:
             writeLog('Using profile likelihood')
             method = 'profileLikelihood'
     
-            if profileLikelihood(cardPath, workdir, vLimits):
+            if checkpointed(ckptdir, method, vLimits, lambda: cached(cardPath, method, '-M ProfileLikelihood -t 20 x 8', vLimits, lambda: profileLikelihood(cardPath, workdir, vLimits))):
                 for iC in range(len(method)):
                     vMethod[iC] = method[iC]
                     vMethod[iC + 1] = '\0'
@@ -290,19 +592,39 @@ def computeLimits(pointName, channels, outputdir, gridfile = ''):
                 print 'ProfileLikelihood method did not converge.'
 
         if FULLCLS:
-            writelog('Creating q_mu grid on the fly')
-
             if limitTree.GetEntries() == 0:
                 writeLog('No estimate of bounds for grid production.')
-                sys.exit(1)
-    
-            gridfile = makeGrid((vLimits['m2s'][0], vLimits['p2s'][0]), cardPath, workdir)
+                outputFile.Close()
+                return False
+
+            bounds = (vLimits['m2s'][0], vLimits['p2s'][0])
 
     if FULLCLS:
         writeLog('Calculating full CLs')
         method = 'fullCLs'
 
-        if fullCLs(cardPath, workdir, vLimits, gridfile):
+        if gridfile:
+            gridOptions = 'grid ' + fileDigest(gridfile)
+        else:
+            # grid is made from the card with fixed seeds when caching, so its settings identify it
+            gridOptions = 'bounds %.6g %.6g adaptive %s %g %d sequential %s %d %d %g' % (bounds[0], bounds[1], ADAPTIVEGRID, GRIDPRECISION, MAXGRIDROUNDS, SEQUENTIALTOYS, TOYCHUNK, MAXTOYS, TOYNSIGMA)
+
+        def calculate():
+            if gridfile:
+                return fullCLs(cardPath, workdir, vLimits, gridfile)
+
+            if not readStage(ckptdir, 'grid')[0]:
+                writeLog('Creating q_mu grid on the fly')
+
+                if RESUME:
+                    restoreGridFiles(workdir, ckptdir)
+
+                shutil.copyfile(makeGrid(bounds, cardPath, workdir, ckptdir), ckptdir + '/HybridGrid.root')
+                writeStage(ckptdir, 'grid', {})
+
+            return fullCLs(cardPath, workdir, vLimits, ckptdir + '/HybridGrid.root')
+
+        if checkpointed(ckptdir, method, vLimits, lambda: cached(cardPath, method, gridOptions, vLimits, calculate)):
             for iC in range(len(method)):
                 vMethod[iC] = method[iC]
                 vMethod[iC + 1] = '\0'
@@ -313,7 +635,8 @@ def computeLimits(pointName, channels, outputdir, gridfile = ''):
 
     if limitTree.GetEntries() == 0:
         writeLog('Failed to calculate limits.')
-        sys.exit(1)
+        outputFile.Close()
+        return False
 
     limitTree.Scan('*')
 
@@ -322,40 +645,195 @@ def computeLimits(pointName, channels, outputdir, gridfile = ''):
 
     shutil.copyfile(workdir + '/' + pointName + '.root', outputdir + '/' + pointName + '.root')
 
+    shutil.rmtree(ckptdir)
+
+    return True
+
+
+def withSignal(channels, signalData):
+    """
+    Copy of the background channels with the signal process of one point added
+    """
+
+    pointChannels = {}
+    for name, channel in channels.items():
+        pointChannel = datacard.Channel(channel.name, channel.lepton, channel.stackName, channel.cut)
+        pointChannel.observed = channel.observed
+        pointChannel.processes = dict(channel.processes)
+        pointChannel.processes['signal'] = signalData[name]
+        pointChannels[name] = pointChannel
+
+    return pointChannels
+
+
+def computeLimitsBatch(model, pointNames, channels, signals, outputdir):
+    """
+    Compute in-process asymptotic limits for all given points of a model at once and write them into a single [outputdir]/[model].root
+    """
+
+    writeLog('Calculating asymptotic limits in process for ' + str(len(pointNames)) + ' points')
+
+    results = asymptoticCLs.asymptoticBatch([withSignal(channels, signals[pointName][0]) for pointName in pointNames])
+
+    limitPoints = ['obs', 'med', 'm2s', 'm1s', 'p1s', 'p2s']
+
+    outputFile = ROOT.TFile.Open(outputdir + '/' + model + '.root', 'recreate')
+    limitTree = ROOT.TTree('limitTree', 'Limit Tree')
+
+    vPointName = array.array('c', '\0' * 100)
+    vMethod = array.array('c', 'nativeAsymptotic\0')
+    vLimits = dict([(p, array.array('d', [0.])) for p in limitPoints])
+
+    limitTree.Branch('pointName', vPointName, 'pointName/C')
+    limitTree.Branch('method', vMethod, 'method/C')
+    for p in limitPoints:
+        limitTree.Branch(p, vLimits[p], p + '/D')
+
+    failed = []
+
+    for pointName, result in zip(pointNames, results):
+        if result is None:
+            failed.append(pointName)
+            continue
+
+        for iC in range(len(pointName)):
+            vPointName[iC] = pointName[iC]
+            vPointName[iC + 1] = '\0'
+
+        for p in limitPoints:
+            vLimits[p][0] = result[p]
+
+        limitTree.Fill()
+
+    outputFile.Write()
+    outputFile.Close()
+
+    if len(failed) != 0:
+        writeLog('Native asymptotic calculation did not converge for', '\n'.join(failed))
+
+    return failed
+
+
+def selectPoints(model, spec, allPoints, shard = ''):
+    """
+    Point names of the model matching spec, a comma-separated list of points or shell-style patterns (e.g. M3_715_*), or 'all'. With shard = 'k/n', only the k-th (0-based) of n interleaved subsets is returned.
+    """
+
+    pointNames = []
+    for pattern in spec.split(','):
+        if pattern == 'all':
+            pattern = '*'
+
+        matches = sorted(fnmatch.filter(allPoints, model + '_' + pattern))
+        if len(matches) == 0:
+            raise RuntimeError('No point matching ' + pattern + ' in model ' + model)
+
+        pointNames += [pointName for pointName in matches if pointName not in pointNames]
+
+    if shard:
+        iShard, nShards = map(int, shard.split('/'))
+        pointNames = pointNames[iShard::nShards]
+
+    return pointNames
+
+
+def computePoint(pointName):
+    """
+    computeLimits for one point with the inputs loaded in __main__. Module-level so that it can be used with a multiprocessing pool.
+    """
+
+    gridfile = GRIDFILE.replace('{point}', pointName)
+
+    if gridfile and os.path.isdir(gridfile):
+        proc = subprocess.Popen('hadd -f ' + gridfile + '/grid_' + pointName + '.root ' + gridfile + '/higgsCombineGrid*.root', shell = True)
+        proc.communicate()
+        if proc.returncode != 0:
+            return False
+
+        gridfile += '/grid_' + pointName + '.root'
+
+    return computeLimits(pointName, withSignal(CHANNELS, SIGNALS[pointName][0]), OUTPUTDIR, gridfile)
+
 
 if __name__ == '__main__':
 
     from optparse import OptionParser
 
-    parser = OptionParser(usage = 'Usage: computeLimits.py model point pickle pkldir outputdir')
-    parser.add_option('-g', '--grid', dest = 'gridfile', default = '', help = 'grid file')
+    parser = OptionParser(usage = 'Usage: computeLimits.py [options] model points pickle pkldir outputdir\n  points: comma-separated list of points or patterns (e.g. M3_715_*), or all')
+    parser.add_option('-g', '--grid', dest = 'gridfile', default = '', help = 'grid file or directory; {point} is replaced by the point name')
+    parser.add_option('-n', '--native', dest = 'native', action = 'store_true', help = 'compute asymptotic limits in process instead of with combine')
+    parser.add_option('-j', '--jobs', dest = 'maxProcs', type = 'int', default = 0, help = 'maximum number of concurrent combine processes, shared by all workers (default: number of CPUs)')
+    parser.add_option('-a', '--adaptive-grid', dest = 'adaptiveGrid', action = 'store_true', help = 'refine the HybridNew grid around the CLs crossings instead of using 100 uniform r-values')
+    parser.add_option('-p', '--grid-precision', dest = 'gridPrecision', type = 'float', default = 0.02, help = 'relative precision of the limits for the adaptive grid')
+    parser.add_option('-q', '--sequential-toys', dest = 'sequentialToys', action = 'store_true', help = 'throw grid toys in chunks and stop once CLs is clearly away from 0.05')
+    parser.add_option('-c', '--cache-dir', dest = 'cacheDir', default = '', help = 'look limits up in (and store them to) this directory, keyed on the datacard, method and options; implies fixed seeds')
+    parser.add_option('-r', '--resume', dest = 'resume', action = 'store_true', help = 'skip the stages recorded as completed in [outputdir]/[model]_[point]_ckpt and reuse the grid toys saved there')
+    parser.add_option('-s', '--shard', dest = 'shard', default = '', help = 'k/n: process only the k-th (0-based) of n interleaved subsets of the selected points')
+    parser.add_option('-w', '--workers', dest = 'workers', type = 'int', default = 1, help = 'number of points processed in parallel')
+    parser.add_option('-b', '--batch', dest = 'batch', action = 'store_true', help = 'compute native asymptotic limits for all selected points at once and write [outputdir]/[model].root')
 
     options, args = parser.parse_args()
 
+    if options.native:
+        NATIVE = True
+
+    MAXPROCS = options.maxProcs
+
+    if options.sequentialToys:
+        SEQUENTIALTOYS = True
+
+    if options.adaptiveGrid:
+        ADAPTIVEGRID = True
+        GRIDPRECISION = options.gridPrecision
+
+    if options.resume:
+        RESUME = True
+
+    if options.cacheDir:
+        CACHEDIR = os.path.realpath(options.cacheDir)
+        FIXEDSEEDS = True
+
     model = args[0]
-    point = args[1]
+    points = args[1]
     result = args[2]
     pkldir = os.path.realpath(args[3])
     outputdir = args[4]
 
+    # inputs are loaded once for all points
+
     with open(pkldir + '/' + result) as source:
         channels = pickle.load(source)
 
-    with open(pkldir + '/' + model + '.pkl') as source:
-        signals = pickle.load(source)
-
-    pointName = model + '_' + point
+    signals = signalStore.openSignals(pkldir, model)
 
-    signalData = signals[pointName][0]
-    for name, channel in channels.items():
-        channel.processes['signal'] = signalData[name]
+    pointNames = selectPoints(model, points, signals.keys(), options.shard)
 
-    if options.gridfile and os.path.isdir(options.gridfile):
-        proc = subprocess.Popen('hadd -f ' + options.gridfile + '/grid_' + pointName + '.root ' + options.gridfile + '/higgsCombineGrid*.root', shell = True)
-        proc.communicate()
-        if proc.returncode != 0:
+    if options.batch:
+        if len(computeLimitsBatch(model, pointNames, channels, signals, outputdir)) != 0:
             sys.exit(1)
 
-        options.gridfile += '/grid_' + pointName + '.root'
+        sys.exit(0)
+
+    GRIDFILE = options.gridfile
+    CHANNELS = channels
+    SIGNALS = signals
+    OUTPUTDIR = outputdir
 
-    computeLimits(pointName, channels, outputdir, options.gridfile)
+    if options.workers > 1 and len(pointNames) > 1:
+        # each worker runs its own schedulers; split the process limit so that the total stays within it
+        if MAXPROCS <= 0:
+            MAXPROCS = multiprocessing.cpu_count()
+        MAXPROCS = max(MAXPROCS / options.workers, 1)
+
+        pool = multiprocessing.Pool(options.workers)
+        success = pool.map(computePoint, pointNames, chunksize = 1)
+        pool.close()
+        pool.join()
+    else:
+        success = map(computePoint, pointNames)
+
+    failed = [pointName for pointName, ok in zip(pointNames, success) if not ok]
+
+    if len(failed) != 0:
+        writeLog('Failed points', '\n'.join(failed))
+        sys.exit(1)
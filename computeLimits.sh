@@ -3,7 +3,7 @@
 GRID=true
 
 MODEL=$1
-POINT=$2
+POINT=$2 # single point or comma-separated list
 SUFFIX=$3
 
 DEST=$HOME/work/limits${SUFFIX}
@@ -18,7 +18,7 @@ eval `scram runtime -sh`
 cd $HOME/src/GammaL/limits
 
 if $GRID; then
-    python computeLimits.py -g $DEST/grid_${MODEL}_${POINT} $MODEL $POINT $RESPKL $PKLDIR $DEST
+    python computeLimits.py -g $DEST/grid_{point} $MODEL $POINT $RESPKL $PKLDIR $DEST
 else
     python computeLimits.py $MODEL $POINT $RESPKL $PKLDIR $DEST
 fi
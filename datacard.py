@@ -1,14 +1,143 @@
 import sys
 import math
 import collections
+import numpy
 import ROOT
 
 sys.path.append('/afs/cern.ch/user/y/yiiyama/src/GammaL/plotstack')
 import locations
 
+import columnCache
+
 LUMI = '19712.'
 
-treeStore = {}
+class TreeStore(object):
+    """
+    Trees by sample name, limited to maxEntries trees and/or maxBytes (sum of TTree::GetTotBytes); 0 means no limit.
+    When a new tree exceeds the budget, the least recently used trees are evicted and their release functions called (sample.releaseTree for trees loaded by the sample). Pinned trees (e.g. those of the point being processed) are never evicted.
+    """
+
+    def __init__(self, maxEntries = 0, maxBytes = 0):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+
+        self.trees = collections.OrderedDict() # name -> (tree, release)
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, name):
+        return name in self.trees
+
+    def __len__(self):
+        return len(self.trees)
+
+    def __getitem__(self, name):
+        tree = self.get(name)
+        if tree is None:
+            raise KeyError(name)
+
+        return tree
+
+    def __setitem__(self, name, tree):
+        self.put(name, tree)
+
+    def get(self, name):
+        """
+        The tree (marked as most recently used) or None.
+        """
+
+        if name not in self.trees:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        entry = self.trees.pop(name)
+        self.trees[name] = entry
+
+        return entry[0]
+
+    def put(self, name, tree, release = None):
+        """
+        Store a tree. release() is called if the tree is evicted.
+        """
+
+        if name in self.trees:
+            self.trees.pop(name)
+
+        self.trees[name] = (tree, release)
+
+        while True:
+            if self.maxEntries > 0 and len(self.trees) > self.maxEntries:
+                pass
+            elif self.maxBytes > 0 and sum([t.GetTotBytes() for t, r in self.trees.values()]) > self.maxBytes:
+                pass
+            else:
+                break
+
+            candidates = [key for key in self.trees if key != name and key not in self.pinned]
+            if len(candidates) == 0:
+                break
+
+            tree, release = self.trees.pop(candidates[0])
+            tree = None
+            if release is not None:
+                release()
+
+            self.evictions += 1
+
+    def putSample(self, sample):
+        """
+        Store the tree loaded by the sample; it is released through the sample on eviction.
+        """
+
+        self.put(sample.name, sample.tree, sample.releaseTree)
+
+    def pin(self, names):
+        self.pinned = set(names)
+
+    def pop(self, name):
+        """
+        Remove and return the tree without calling its release function.
+        """
+
+        return self.trees.pop(name)[0]
+
+    def clear(self):
+        """
+        Remove all trees, calling their release functions.
+        """
+
+        while len(self.trees) != 0:
+            tree, release = self.trees.popitem(last = False)[1]
+            tree = None
+            if release is not None:
+                release()
+
+        self.pinned = set()
+
+    def stats(self):
+        return 'treeStore: %d trees, %d hits, %d misses, %d evictions' % (len(self.trees), self.hits, self.misses, self.evictions)
+
+
+def dropTree(tree):
+    """
+    Release function for trees made in memory (e.g. with CopyTree): the object is detached from its directory and deleted once unreferenced.
+    """
+
+    directory = tree.GetDirectory()
+    if directory:
+        directory.Remove(tree)
+
+    ROOT.SetOwnership(tree, True)
+
+
+treeStore = TreeStore()
+columnStore = {} # sample name -> columnCache.Evaluator on the cached columns; used instead of the tree when present
+
+BITSPERCOLUMN = 30 # cut decisions packed into one TTree::Draw column of the yield book
 
 GenInfo = collections.namedtuple('GenInfo', ['xsec', 'relErr', 'nEvents'])
 
@@ -39,12 +168,73 @@ class Process(object):
         return int(round(R2 / D))
 
 
+class Binning(object):
+    """
+    Channels as the bins of a grid of axes (variable, edges, labels) within a preselection. A bin holds the events with edges[i] <= variable < edges[i + 1] on every axis; infinite edges leave the side open.
+    Samples are filled into all bins at once (YieldBook.bookBinning) instead of evaluating one cut per channel.
+    """
+
+    def __init__(self, preselection, axes):
+        self.preselection = preselection
+        self.axes = axes
+
+    def shape(self):
+        return tuple([len(edges) - 1 for variable, edges, labels in self.axes])
+
+    def indices(self):
+        return list(numpy.ndindex(*self.shape()))
+
+    def label(self, index):
+        return ''.join([labels[i] for (variable, edges, labels), i in zip(self.axes, index)])
+
+    def cut(self, index):
+        """
+        Cut string of the bin, equivalent to the binned selection.
+        """
+
+        conditions = [self.preselection]
+        for (variable, edges, labels), i in zip(self.axes, index):
+            if edges[i] != -float('inf'):
+                conditions.append('%s >= %s' % (variable, repr(edges[i])))
+            if edges[i + 1] != float('inf'):
+                conditions.append('%s < %s' % (variable, repr(edges[i + 1])))
+
+        return ' && '.join(conditions)
+
+    def fill(self, values, weights):
+        """
+        Arrays (sumw, sumw2, count) of the bin shape from the per-event axis values and weights (0 for events failing the preselection). count is the number of events with non-zero weight, as in getRateAndCount.
+        """
+
+        shape = self.shape()
+        size = int(numpy.prod(shape))
+
+        inside = numpy.ones(len(weights), dtype = bool)
+        indices = []
+        for (variable, edges, labels), x in zip(self.axes, values):
+            # NaN (missing array element) sorts after all edges and falls outside
+            index = numpy.searchsorted(numpy.array(edges, dtype = numpy.float64), x, side = 'right') - 1
+            inside &= (index >= 0) & (index < len(edges) - 1)
+            indices.append(index)
+
+        flat = numpy.ravel_multi_index([index[inside] for index in indices], shape)
+        w = weights[inside]
+
+        sumw = numpy.bincount(flat, weights = w, minlength = size).reshape(shape)
+        sumw2 = numpy.bincount(flat, weights = w * w, minlength = size).reshape(shape)
+        count = numpy.bincount(flat[w != 0.], minlength = size).reshape(shape)
+
+        return sumw, sumw2, count
+
+
 class Channel(object):
-    def __init__(self, name, lepton, stackName, cut):
+    def __init__(self, name, lepton, stackName, cut, binning = None, index = None):
         self.name = name
         self.lepton = lepton
         self.stackName = stackName
         self.cut = cut
+        self.binning = binning # Binning the channel is a bin of (cut = binning.cut(index)), or None
+        self.index = index
 
         self.observed = 0
         self.processes = {}
@@ -53,26 +243,216 @@ class Channel(object):
         return sum([p.rate() for p in self.processes.values() if not p.signal])
 
 
-def getRateAndCount(sample, cut, weight = ''):
+def getTree(sample):
+    tree = treeStore.get(sample.name)
+    if tree is not None:
+        return tree
 
-    ROOT.gROOT.cd()
-    counter = ROOT.TH1D('counter', 'counter', 1, 0., 1.)
+    sample.loadTree(locations.eventListDir)
+    return sample.tree
 
-    if sample.name in treeStore:
-        tree = treeStore[sample.name]
-    else:
-        sample.loadTree(locations.eventListDir)
-        tree = sample.tree
 
-    ROOT.gROOT.cd()
+def releaseTree(sample):
+    if sample.name not in treeStore:
+        sample.releaseTree()
+
+
+def eventWeight(weight = ''):
     wstr = 'eventSigma * ' + LUMI + ' * puWeight * effScale'
     if weight:
         wstr += ' * (' + weight + ')'
-    tree.Draw('0.5>>+counter', wstr + ' * (' + cut + ')', 'goff')
 
-    if sample.name not in treeStore:        
+    return wstr
+
+
+def shiftVariables(suffix):
+    """
+    Substitution of met, mt and ht by their systematic variations (e.g. metJESUp).
+    """
+
+    return dict([(var, var + suffix) for var in ['met', 'mt', 'ht']])
+
+
+class YieldBook(object):
+    """
+    Rates and counts booked up front for (sample, cut, weight) and filled with a single TTree::Draw per sample when the first of them is requested.
+    The decisions of all cuts are packed as bits into BITSPERCOLUMN-wide columns and each distinct weight is one more column, so the event loop runs once however many channels and variations are booked.
+    Channels that are bins of a Binning are booked as a whole (bookBinning): only the preselection and the axis variables are drawn, and all bins are filled at once. Their results are stored under the bin cuts, so they are retrieved like any other booking.
+    """
+
+    def __init__(self):
+        self.booked = {} # sample name -> [(cut, weight)]
+        self.binned = {} # sample name -> [(binning, substitution, weight)]
+        self.results = {} # (sample name, cut, weight) -> (rate, count)
+        self.histograms = {} # (sample name, binning, substitution, weight) -> (sumw, sumw2, count) arrays of the binned bookings
+        self.cachedOnly = False # if True, requesting a yield that is not in results raises instead of reading events (yields injected from yieldCache)
+
+    def book(self, sample, cut, weight = ''):
+        if (sample.name, cut, weight) in self.results: return
+
+        bookings = self.booked.setdefault(sample.name, [])
+        if (cut, weight) not in bookings:
+            bookings.append((cut, weight))
+
+    def bookBinning(self, sample, binning, substitution = {}, weight = ''):
+        """
+        Book all bins of the binning, with the variables substituted (systematic variation) in the preselection and axes.
+        """
+
+        substitution = tuple(sorted(substitution.items()))
+
+        firstBin = columnCache.renameVariables(binning.cut(binning.indices()[0]), dict(substitution))
+        if (sample.name, firstBin, weight) in self.results: return
+
+        bookings = self.binned.setdefault(sample.name, [])
+        if (binning, substitution, weight) not in bookings:
+            bookings.append((binning, substitution, weight))
+
+    def get(self, sample, cut, weight = ''):
+        """
+        (rate, count) as returned by getRateAndCount, or None if the combination was not booked.
+        """
+
+        key = (sample.name, cut, weight)
+        if key not in self.results:
+            if self.cachedOnly:
+                raise RuntimeError('No cached yield of ' + sample.name + ' for cut ' + cut + ' and weight ' + repr(weight))
+
+            if sample.name not in self.booked and sample.name not in self.binned:
+                return None
+
+            self.fill(sample)
+
+        return self.results.get(key)
+
+    def forget(self, sample):
+        self.booked.pop(sample.name, None)
+        self.binned.pop(sample.name, None)
+        for key in [key for key in self.results if key[0] == sample.name]:
+            self.results.pop(key)
+        for key in [key for key in self.histograms if key[0] == sample.name]:
+            self.histograms.pop(key)
+
+    def clear(self):
+        self.booked = {}
+        self.binned = {}
+        self.results = {}
+        self.histograms = {}
+
+    def getHistograms(self, sample, binning):
+        """
+        Dict (substitution, weight) -> (sumw, sumw2, count) of the filled bookings of the binning.
+        """
+
+        return dict([(key[2:], value) for key, value in self.histograms.items() if key[0] == sample.name and key[1] is binning])
+
+    def addHistogram(self, sampleName, binning, substitution, weight, sumw, sumw2, count):
+        """
+        Store the yields of all bins of the binning, filled here or read from a cache (yieldCache).
+        """
+
+        self.histograms[(sampleName, binning, substitution, weight)] = (sumw, sumw2, count)
+
+        substitution = dict(substitution)
+
+        for index in binning.indices():
+            key = (sampleName, columnCache.renameVariables(binning.cut(index), substitution), weight)
+            self.results[key] = (float(sumw[index]), int(count[index]))
+
+    def fill(self, sample):
+        bookings = self.booked.pop(sample.name, [])
+        binnedBookings = self.binned.pop(sample.name, [])
+
+        cuts = []
+        weights = []
+        for cut, weight in bookings:
+            if cut not in cuts: cuts.append(cut)
+            if weight not in weights: weights.append(weight)
+
+        variables = []
+        for binning, substitution, weight in binnedBookings:
+            preselection = columnCache.renameVariables(binning.preselection, dict(substitution))
+            if preselection not in cuts: cuts.append(preselection)
+            if weight not in weights: weights.append(weight)
+            for variable, edges, labels in binning.axes:
+                variable = columnCache.renameVariables(variable, dict(substitution))
+                if variable not in variables: variables.append(variable)
+
+        columns = []
+        for iStart in range(0, len(cuts), BITSPERCOLUMN):
+            columns.append(' + '.join(['%d * (%s)' % (1 << iBit, cut) for iBit, cut in enumerate(cuts[iStart:iStart + BITSPERCOLUMN])]))
+
+        nBitColumns = len(columns)
+
+        for weight in weights:
+            columns.append(columnCache.expandLookups(eventWeight(weight)))
+
+        for variable in variables:
+            # NaN for missing array elements, which then fall outside of all bins
+            if '[' in variable:
+                columns.append('Alt$(' + variable + ', sqrt(-1.))')
+            else:
+                columns.append(variable)
+
+        tree = getTree(sample)
+
+        # more than 4 columns are allowed with goff; values are read with GetVal
+        tree.SetEstimate(tree.GetEntries() + 1)
+        nEntries = tree.Draw(':'.join(columns), '', 'goff')
+
+        values = []
+        for iCol in range(len(columns)):
+            buf = tree.GetVal(iCol)
+            buf.SetSize(nEntries)
+            values.append(numpy.frombuffer(buf, dtype = numpy.float64, count = nEntries).copy())
+
         tree = None
-        sample.releaseTree()
+        releaseTree(sample)
+
+        bits = [numpy.rint(column).astype(numpy.int64) for column in values[:nBitColumns]]
+        eventWeights = dict(zip(weights, values[nBitColumns:nBitColumns + len(weights)]))
+        variableValues = dict(zip(variables, values[nBitColumns + len(weights):]))
+
+        def passing(cut):
+            iCut = cuts.index(cut)
+            return ((bits[iCut / BITSPERCOLUMN] >> (iCut % BITSPERCOLUMN)) & 1) == 1
+
+        for cut, weight in bookings:
+            w = eventWeights[weight][passing(cut)]
+
+            self.results[(sample.name, cut, weight)] = (float(numpy.sum(w)), int(numpy.count_nonzero(w)))
+
+        for binning, substitution, weight in binnedBookings:
+            preselection = columnCache.renameVariables(binning.preselection, dict(substitution))
+            w = numpy.where(passing(preselection), eventWeights[weight], 0.)
+            axisValues = [variableValues[columnCache.renameVariables(variable, dict(substitution))] for variable, edges, labels in binning.axes]
+
+            self.addHistogram(sample.name, binning, substitution, weight, *binning.fill(axisValues, w))
+
+
+yieldBook = YieldBook()
+
+
+def getRateAndCount(sample, cut, weight = ''):
+
+    if sample.name in columnStore:
+        w = columnStore[sample.name](eventWeight(weight) + ' * (' + cut + ')') * numpy.ones(1)
+        return float(numpy.sum(w)), int(numpy.count_nonzero(w))
+
+    booked = yieldBook.get(sample, cut, weight)
+    if booked is not None:
+        return booked
+
+    ROOT.gROOT.cd()
+    counter = ROOT.TH1D('counter', 'counter', 1, 0., 1.)
+
+    tree = getTree(sample)
+
+    ROOT.gROOT.cd()
+    tree.Draw('0.5>>+counter', columnCache.expandLookups(eventWeight(weight) + ' * (' + cut + ')'), 'goff')
+
+    tree = None
+    releaseTree(sample)
 
     rate = counter.GetBinContent(1)
     count = int(counter.GetEntries())
@@ -88,66 +468,148 @@ def boundVal(val, bound = 1.):
     return val
 
 
-def getJESUncert(samplesAndScales, cut, nominal):
-    
-    if nominal <= 0.: return 0.
+class Variation(object):
+    """
+    A shifted selection: variables substituted in the cut (e.g. met -> metJESUp) and/or an additional event weight, given as an expression or as a function channel -> expression.
+    """
 
-    up = 0.
-    down = 0.
-    for sample, scale in samplesAndScales:
-        cutUp = cut.replace(' met ', ' metJESUp ').replace(' mt ', ' mtJESUp ').replace(' ht ', ' htJESUp ')
-        up += getRateAndCount(sample, cutUp)[0] * scale
+    def __init__(self, substitution = {}, weight = ''):
+        self.substitution = substitution
+        self.weight = weight
 
-        cutDown = cut.replace(' met ', ' metJESDown ').replace(' mt ', ' mtJESDown ').replace(' ht ', ' htJESDown ')
-        down += getRateAndCount(sample, cutDown)[0] * scale
+    def cut(self, cut):
+        if len(self.substitution) == 0:
+            return cut
 
-    shiftUp = (nominal - up) / nominal
-    shiftDown = (down - nominal) / nominal
+        return columnCache.renameVariables(cut, self.substitution)
 
-    if abs(shiftUp) < 5.e-4 and abs(shiftDown) < 5.e-4:
-        return 0.
+    def eventWeight(self, channel):
+        if callable(self.weight):
+            return self.weight(channel)
 
-    # use the sign of upward JES shift unless shiftUp == 0
-    try:
-        sign = shiftUp / abs(shiftUp)
-    except ZeroDivisionError:
-        sign = shiftDown / abs(shiftDown)
-    
-    return boundVal(max(abs(shiftUp), abs(shiftDown)) * sign)
+        return self.weight
 
 
-def getJERUncert(samplesAndScales, cut, nominal):
-    
-    if nominal <= 0.: return 0.
+class Systematic(object):
+    """
+    Nuisance computed from the yields of one or two variations relative to the nominal yield.
+    The relative shift of a variation is sign * (varied - nominal) / nominal (sign * (nominal - varied) / nominal for down). With both, the larger shift is taken with the sign of the up shift. Shifts below threshold are set to 0.
+    """
+
+    def __init__(self, name, up, down = None, sign = 1., absolute = False, threshold = 5.e-4):
+        self.name = name
+        self.up = up
+        self.down = down
+        self.sign = sign
+        self.absolute = absolute
+        self.threshold = threshold
+
+    def variations(self):
+        if self.down is None:
+            return [self.up]
+
+        return [self.up, self.down]
+
+    def shift(self, nominal, up, down = None):
+        shiftUp = self.sign * (up - nominal) / nominal
+        if down is None:
+            shiftDown = 0.
+        else:
+            shiftDown = self.sign * (nominal - down) / nominal
+
+        if abs(shiftUp) < self.threshold and abs(shiftDown) < self.threshold:
+            return 0.
+
+        if shiftUp == 0. and shiftDown == 0.:
+            return 0.
+
+        if shiftUp != 0.:
+            sign = shiftUp / abs(shiftUp)
+        else:
+            sign = shiftDown / abs(shiftDown)
+
+        value = boundVal(max(abs(shiftUp), abs(shiftDown)) * sign)
+
+        if self.absolute:
+            return abs(value)
+
+        return value
+
+
+systematics = {}
+
+def addSystematic(systematic):
+    """
+    Register a systematic (replacing one with the same name) to be used with bookSystematics and getShifts.
+    """
+
+    systematics[systematic.name] = systematic
 
-    center = 0.
-    up = 0.
-    down = 0.
-    for sample, scale in samplesAndScales:
-#        cut = cut.replace(' met ', ' metSmeared ').replace(' mt ', ' mtSmeared ').replace(' ht ', ' htSmeared ')
-#        center += getRateAndCount(sample, cut)[0] * scale
 
-        cutUp = cut.replace(' met ', ' metSmearedUp ').replace(' mt ', ' mtSmearedUp ').replace(' ht ', ' htSmearedUp ')
-        up += getRateAndCount(sample, cutUp)[0] * scale
+def getSystematic(systematic):
+    """
+    The registered systematic of the name, or the argument itself if it is a Systematic (e.g. one that differs between signal points and is not registered).
+    """
 
-#        cutDown = cut.replace(' met ', ' metSmearedDown ').replace(' mt ', ' mtSmearedDown ').replace(' ht ', ' htSmearedDown ')
-#        down += getRateAndCount(sample, cutDown)[0] * scale
+    if isinstance(systematic, Systematic):
+        return systematic
 
-    shiftUp = (nominal - up) / nominal
-#    shiftDown = (down - nominal) / nominal
-    shiftDown = 0.
+    return systematics[systematic]
 
-    if abs(shiftUp) < 5.e-4 and abs(shiftDown) < 5.e-4:
-        return 0.
 
-    if abs(shiftUp) > abs(shiftDown):
-        return boundVal(shiftUp)
-        
+addSystematic(Systematic('jes', Variation(shiftVariables('JESUp')), Variation(shiftVariables('JESDown')), sign = -1.))
+addSystematic(Systematic('jer', Variation(shiftVariables('SmearedUp')), sign = -1.))
+
+
+def bookSystematics(sample, channel, names):
+    """
+    Book the nominal yield of the sample in the channel and the yields of all variations of the systematics (names or Systematic objects), so that they are filled in one pass.
+    """
+
+    bookVariation(sample, channel, Variation())
+
+    for name in names:
+        for variation in getSystematic(name).variations():
+            bookVariation(sample, channel, variation)
+
+
+def bookVariation(sample, channel, variation):
+    # channels loaded from pickles written before binnings were introduced have no binning attribute
+    if getattr(channel, 'binning', None) is None:
+        yieldBook.book(sample, variation.cut(channel.cut), variation.eventWeight(channel))
     else:
-        if shiftDown * shiftUp < 0.:
-            return boundVal(-shiftDown)
-        else:
-            return boundVal(shiftDown)
+        yieldBook.bookBinning(sample, channel.binning, variation.substitution, variation.eventWeight(channel))
+
+
+def getShifts(samplesAndScales, channel, nominal, names):
+    """
+    Dict name -> relative shift (boundVal-ed) of the scaled sum of the sample yields in the channel for the named systematics.
+    """
+
+    shifts = {}
+
+    for name in names:
+        if nominal <= 0.:
+            shifts[name] = 0.
+            continue
+
+        shifts[name] = systematics[name].shift(nominal, *getVariedYields(samplesAndScales, channel, name))
+
+    return shifts
+
+
+def getVariedYields(samplesAndScales, channel, name):
+    """
+    List of the scaled sums of the sample yields in the channel, one per variation of the systematic (name or Systematic object).
+    """
+
+    yields = []
+    for variation in getSystematic(name).variations():
+        cut = variation.cut(channel.cut)
+        weight = variation.eventWeight(channel)
+        yields.append(sum([getRateAndCount(sample, cut, weight)[0] * scale for sample, scale in samplesAndScales]))
+
+    return yields
 
 
 def writeDataCard(channels, cardName):
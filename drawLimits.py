@@ -1,9 +1,10 @@
 import re
 import math
 import array
-import pickle
 import ROOT
 
+import signalStore
+
 ROOT.gROOT.SetBatch(True)
 rootlogon = ROOT.gEnv.GetValue("Rint.Logon", "")
 if rootlogon:
@@ -185,7 +186,7 @@ def drawLimits(model, sourceName, plotsDir, pointFormat, titles, order, axisRang
     inputTree.SetBranchAddress('p1s', vLimP1s)
     inputTree.SetBranchAddress('p2s', vLimP2s)
 
-    methodPriority = {'asymptotic': 0, 'profileLikelihood': 1, 'fullCLs': 2}
+    methodPriority = {'asymptotic': 0, 'nativeAsymptotic': 0, 'profileLikelihood': 1, 'fullCLs': 2}
 
     limits = dict([(i, {}) for i in range(-2, 4)])
    
@@ -232,8 +233,7 @@ def drawLimits(model, sourceName, plotsDir, pointFormat, titles, order, axisRang
     nEvents = {}
     yields = {'Electron': {}, 'Muon': {}}
        
-    with open('/afs/cern.ch/user/y/yiiyama/output/GammaL/limits/' + model + '.pkl', 'rb') as pickleSource:
-        datacard = pickle.load(pickleSource)
+    datacard = signalStore.openSignals('/afs/cern.ch/user/y/yiiyama/output/GammaL/limits', model)
 
     for pointName, coord in coords.items():
         processes, genInfo = datacard[pointName]
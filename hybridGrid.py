@@ -0,0 +1,182 @@
+import re
+import math
+import ROOT
+
+CLS = 0.05
+QUANTILES = ['0.025', '0.16', '0.5', '0.84', '0.975']
+
+def readGrid(fileNames):
+    """
+    Collect the HypoTestResults saved by combine -M HybridNew --saveHybridResult. Results for the same r-value (different seeds / files) are merged. Returns a dict r -> HypoTestResult.
+    """
+
+    results = {}
+
+    for fileName in fileNames:
+        source = ROOT.TFile.Open(fileName)
+        if not source or source.IsZombie(): continue
+
+        toys = source.Get('toys')
+        if not toys:
+            source.Close()
+            continue
+
+        for key in toys.GetListOfKeys():
+            if key.GetClassName() != 'RooStats::HypoTestResult': continue
+
+            # object names are HypoTestResult_mh{mass}_r{rvalue}_{seed}
+            matches = re.match('HypoTestResult_mh[^_]+_r([^_]+)_', key.GetName())
+            if not matches: continue
+
+            rval = float(matches.group(1))
+            result = key.ReadObj()
+
+            if rval in results:
+                results[rval].Append(result)
+            else:
+                results[rval] = result.Clone()
+
+        source.Close()
+
+    return results
+
+
+def getCLs(result, quantile = ''):
+    """
+    Observed (quantile = '') or expected CLs and its error at one grid point. The expected test statistic is taken from the b-only toys in the same way as combine --expectedFromGrid.
+    """
+
+    if not quantile:
+        return result.CLs(), result.CLsError()
+
+    btoys = sorted(list(result.GetAltDistribution().GetSamplingDistribution()))
+    if len(btoys) == 0:
+        return 1., 1.
+
+    index = min(int(math.floor((1. - float(quantile)) * len(btoys) + 0.5)), len(btoys) - 1)
+
+    expected = result.Clone()
+    expected.SetTestStatisticData(btoys[index])
+
+    return expected.CLs(), expected.CLsError()
+
+
+def clsTable(results):
+    """
+    Dict r -> {target: (CLs, error)} with targets 'obs' and the expected quantiles.
+    """
+
+    table = {}
+    for rval, result in results.items():
+        table[rval] = {'obs': getCLs(result)}
+        for quant in QUANTILES:
+            table[rval][quant] = getCLs(result, quant)
+
+    return table
+
+
+def findCrossing(table, target):
+    """
+    Bracket of the CLs = 0.05 crossing for one target. Returns (rlow, rhigh, rcross, rerr), with rlow or rhigh set to None if the crossing is outside the scanned range.
+    """
+
+    rvalues = sorted(table.keys())
+
+    for iR in range(len(rvalues) - 1):
+        rlow = rvalues[iR]
+        rhigh = rvalues[iR + 1]
+        clsLow, errLow = table[rlow][target]
+        clsHigh, errHigh = table[rhigh][target]
+
+        if clsLow >= CLS and clsHigh < CLS:
+            break
+    else:
+        if len(rvalues) == 0:
+            return None, None, None, None
+        elif table[rvalues[0]][target][0] < CLS:
+            # crossing below the scanned range
+            return None, rvalues[0], None, None
+        else:
+            # crossing above the scanned range
+            return rvalues[-1], None, None, None
+
+    # interpolate linearly in log(CLs)
+    lnLow = math.log(max(clsLow, 1.e-6))
+    lnHigh = math.log(max(clsHigh, 1.e-6))
+    lnTarget = math.log(CLS)
+
+    if lnLow == lnHigh:
+        return rlow, rhigh, 0.5 * (rlow + rhigh), 0.
+
+    rcross = rlow + (rhigh - rlow) * (lnLow - lnTarget) / (lnLow - lnHigh)
+
+    # statistical uncertainty of the crossing from the CLs errors at the bracket ends
+    dr = (rhigh - rlow) / abs(lnLow - lnHigh)
+    rerr = dr * math.sqrt(math.pow(errLow / max(clsLow, 1.e-6), 2.) + math.pow(errHigh / max(clsHigh, 1.e-6), 2.)) * 0.5
+
+    return rlow, rhigh, rcross, rerr
+
+
+def nextRValues(table, precision):
+    """
+    r-values to add to the grid so that every CLs = 0.05 crossing (observed and expected) is bracketed to within the relative precision. An empty list means the grid is complete.
+    Crossings whose bracket is already narrower than their statistical uncertainty are not refined further (more toys are needed there, not more points).
+    """
+
+    candidates = []
+
+    for target in ['obs'] + QUANTILES:
+        rlow, rhigh, rcross, rerr = findCrossing(table, target)
+
+        if rlow is None:
+            if rhigh is None: continue
+            candidates.append(rhigh * 0.5)
+            continue
+
+        if rhigh is None:
+            candidates.append(rlow * 2.)
+            continue
+
+        width = rhigh - rlow
+        if width < 2. * precision * rcross or width < rerr:
+            continue
+
+        # keep new points away from the bracket edges so that each round shrinks the bracket substantially
+        rnew = min(max(rcross, rlow + 0.1 * width), rhigh - 0.1 * width)
+        candidates.append(rnew)
+
+    rvalues = []
+    for rval in sorted(candidates):
+        if len(rvalues) != 0 and rval - rvalues[-1] < precision * rval: continue
+        rvalues.append(rval)
+
+    return rvalues
+
+
+def isDecided(result, nSigma):
+    """
+    True if the observed and all expected CLs values at this grid point are more than nSigma (binomial) errors away from 0.05, i.e. more toys would not change which side of the crossing the point is on.
+    """
+
+    for target in [''] + QUANTILES:
+        cls, err = getCLs(result, target)
+        if abs(cls - CLS) <= nSigma * err:
+            return False
+
+    return True
+
+
+def isValidGridFile(fileName):
+    """
+    True if the file is a complete combine HybridNew output with saved toys, i.e. it was not truncated by a killed job.
+    """
+
+    source = ROOT.TFile.Open(fileName)
+    if not source or source.IsZombie():
+        return False
+
+    valid = not source.TestBit(ROOT.TFile.kRecovered) and bool(source.Get('toys')) and bool(source.Get('limit'))
+
+    source.Close()
+
+    return valid
@@ -0,0 +1,74 @@
+import os
+import json
+import hashlib
+
+import columnCache
+
+def fileFingerprint(path):
+    """
+    Name, size and modification time of a local file (name only for remote paths).
+    """
+
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return '%s %d %d' % (path, stat.st_size, stat.st_mtime)
+
+    return path
+
+
+sampleFingerprints = {}
+
+def sampleFingerprint(sample, sourceDir):
+    """
+    Fingerprint of the input files of the sample tree (columnCache.fingerprint), computed once per process.
+    """
+
+    key = (sample.name, sourceDir)
+    if key not in sampleFingerprints:
+        sample.loadTree(sourceDir)
+        tree = sample.tree
+
+        parts = [columnCache.fingerprint(tree, '')]
+
+        tree = None
+        sample.releaseTree()
+
+        sampleFingerprints[key] = digest(parts)
+
+    return sampleFingerprints[key]
+
+
+def channelDefinition(channel):
+    return (channel.name, channel.lepton, channel.stackName, channel.cut)
+
+
+def digest(parts):
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+
+class Manifest(object):
+    """
+    Input fingerprints of the records (points or channels) of an output file, stored as JSON in [output].manifest.
+    Only inputs are fingerprinted; rebuild from scratch after changing the code that computes the records.
+    """
+
+    def __init__(self, outputName):
+        self.path = outputName + '.manifest'
+
+        try:
+            with open(self.path) as source:
+                self.fingerprints = json.load(source)
+        except IOError:
+            self.fingerprints = {}
+
+    def upToDate(self, key, fingerprint):
+        return self.fingerprints.get(key) == fingerprint
+
+    def update(self, key, fingerprint):
+        self.fingerprints[key] = fingerprint
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as output:
+            json.dump(self.fingerprints, output, indent = 0, sort_keys = True)
+
+        os.rename(self.path + '.tmp', self.path)
@@ -0,0 +1,275 @@
+import os
+import re
+import sys
+import shutil
+import hashlib
+import threading
+import subprocess
+import collections
+import Queue
+
+# run in a separate process so that no ROOT call is made from the prefetch thread
+COPYSCRIPT = '''import sys
+import ROOT
+source = ROOT.TFile.Open(sys.argv[1])
+if not source or source.IsZombie(): sys.exit(1)
+print 'SIZE', source.GetSize()
+source.Close()
+if not ROOT.TFile.Cp(sys.argv[1], sys.argv[2], False): sys.exit(1)
+'''
+
+def checksum(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as source:
+        while True:
+            block = source.read(1024 * 1024)
+            if not block: break
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+class Mirror(object):
+    """
+    Read-through local copy of remote files (rooth://host//store/... and /store/...) under directory, limited to maxBytes (0 = no limit; least recently used files are removed first).
+    Each copy is checked against the source size and has a [file].sha1 sidecar (size and SHA1 of the copy); with verify = True the checksum is recomputed whenever a copy is reused.
+    Files can be prefetched by a background thread while the current files are being processed. Files of the samples in use (localDir/prefetch until release) are never removed.
+    Sources that are local paths are copied directly, so a local directory can stand in for the remote store.
+    """
+
+    def __init__(self, directory, maxBytes = 0, verify = False):
+        self.directory = os.path.realpath(directory)
+        self.maxBytes = maxBytes
+        self.verify = verify
+
+        self.lock = threading.Condition()
+        self.files = collections.OrderedDict() # local path -> size, least recently used first
+        self.fetching = set()
+        self.pinned = set()
+        self.fileLists = {} # (sample name, source dir) -> list of source file names
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._queue = None
+        self._pid = 0
+
+        existing = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                path = dirpath + '/' + name
+                if '.part' in name:
+                    # interrupted copy
+                    os.remove(path)
+                elif name.endswith('.sha1'):
+                    if not os.path.exists(path[:-5]):
+                        os.remove(path)
+                elif not os.path.exists(path + '.sha1'):
+                    os.remove(path)
+                else:
+                    existing.append((os.path.getmtime(path), path))
+
+        for mtime, path in sorted(existing):
+            self.files[path] = os.path.getsize(path)
+
+    def localPath(self, url):
+        matches = re.match('[a-z]+://([^/]+)/(/.*)', url)
+        if matches:
+            path = '/' + matches.group(1) + matches.group(2)
+        elif url.startswith('/'):
+            path = url
+        else:
+            raise RuntimeError('Cannot mirror ' + url)
+
+        return self.directory + os.path.normpath(path)
+
+    def isValid(self, path):
+        try:
+            with open(path + '.sha1') as source:
+                size, sha = source.read().split()
+        except (IOError, ValueError):
+            return False
+
+        if not os.path.exists(path) or os.path.getsize(path) != int(size):
+            return False
+
+        if self.verify and checksum(path) != sha:
+            return False
+
+        return True
+
+    def get(self, url):
+        """
+        Local path of a valid copy of url, copied now if necessary. Waits if the file is being fetched by another thread.
+        """
+
+        path = self.localPath(url)
+
+        with self.lock:
+            while path in self.fetching:
+                self.lock.wait()
+
+            if path in self.files and self.isValid(path):
+                self.files[path] = self.files.pop(path)
+                self.hits += 1
+                return path
+
+            self.files.pop(path, None)
+            self.fetching.add(path)
+            self.misses += 1
+
+        try:
+            size = self.copy(url, path)
+        finally:
+            with self.lock:
+                self.fetching.discard(path)
+                self.lock.notify_all()
+
+        with self.lock:
+            self.files[path] = size
+            self.evict()
+
+        return path
+
+    def copy(self, url, path):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+
+        tmpName = path + '.part' + str(os.getpid())
+
+        if os.path.exists(url):
+            size = os.path.getsize(url)
+            shutil.copyfile(url, tmpName)
+        else:
+            proc = subprocess.Popen([sys.executable, '-c', COPYSCRIPT, url, tmpName], stdout = subprocess.PIPE)
+            out = proc.communicate()[0]
+            sizes = [int(line.split()[1]) for line in out.split('\n') if line.startswith('SIZE ')]
+            if proc.returncode != 0 or len(sizes) == 0:
+                if os.path.exists(tmpName):
+                    os.remove(tmpName)
+                raise RuntimeError('Failed to copy ' + url)
+
+            size = sizes[0]
+
+        if os.path.getsize(tmpName) != size:
+            os.remove(tmpName)
+            raise RuntimeError('Incomplete copy of ' + url)
+
+        with open(tmpName + '.sha1', 'w') as output:
+            output.write('%d %s\n' % (size, checksum(tmpName)))
+
+        os.rename(tmpName, path)
+        os.rename(tmpName + '.sha1', path + '.sha1')
+
+        return size
+
+    def evict(self):
+        # called with the lock held
+        if self.maxBytes <= 0:
+            return
+
+        total = sum(self.files.values())
+
+        for path in list(self.files.keys()):
+            if total <= self.maxBytes:
+                break
+
+            if path in self.pinned or path in self.fetching:
+                continue
+
+            total -= self.files.pop(path)
+            os.remove(path)
+            os.remove(path + '.sha1')
+            self.evictions += 1
+
+    def queue(self):
+        # the thread does not survive fork (multiprocessing workers)
+        if self._queue is None or self._pid != os.getpid():
+            self._queue = Queue.Queue()
+            self._pid = os.getpid()
+
+            thread = threading.Thread(target = self.prefetchLoop, args = (self._queue,))
+            thread.daemon = True
+            thread.start()
+
+        return self._queue
+
+    def prefetchLoop(self, queue):
+        while True:
+            url = queue.get()
+            try:
+                self.get(url)
+            except Exception as ex:
+                # retried (and reported) when the file is actually needed
+                print 'Prefetch of', url, 'failed:', str(ex)
+
+    def sampleFiles(self, sample, sourceDir):
+        """
+        Source file names of the sample tree, read once from the remote tree.
+        """
+
+        key = (sample.name, sourceDir)
+        if key not in self.fileLists:
+            sample.loadTree(sourceDir)
+            tree = sample.tree
+            if tree.InheritsFrom('TChain'):
+                self.fileLists[key] = [element.GetTitle() for element in tree.GetListOfFiles()]
+            else:
+                self.fileLists[key] = [tree.GetCurrentFile().GetName()]
+
+            tree = None
+            sample.releaseTree()
+
+        return self.fileLists[key]
+
+    def pin(self, sample, sourceDir):
+        urls = self.sampleFiles(sample, sourceDir)
+        if len([url for url in urls if not url.startswith(sourceDir)]) != 0:
+            return []
+
+        with self.lock:
+            self.pinned.update([self.localPath(url) for url in urls])
+
+        return urls
+
+    def prefetch(self, sample, sourceDir):
+        """
+        Start copying the files of the sample in the background.
+        """
+
+        for url in self.pin(sample, sourceDir):
+            self.queue().put(url)
+
+    def localDir(self, sample, sourceDir):
+        """
+        Mirror of sourceDir to load the sample from, once its files are copied. Falls back to sourceDir if the sample reads files outside of it.
+        """
+
+        urls = self.pin(sample, sourceDir)
+        if len(urls) == 0:
+            print 'Not mirroring', sample.name, '(files outside', sourceDir + ')'
+            return sourceDir
+
+        for url in urls:
+            self.get(url)
+
+        return self.localPath(sourceDir)
+
+    def release(self, sample, sourceDir):
+        """
+        Allow the files of the sample to be removed from the mirror.
+        """
+
+        key = (sample.name, sourceDir)
+        if key not in self.fileLists:
+            return
+
+        with self.lock:
+            self.pinned.difference_update([self.localPath(url) for url in self.fileLists[key]])
+            self.evict()
+
+    def stats(self):
+        return 'mirror: %d files, %.1f MB, %d hits, %d misses, %d evictions' % (len(self.files), sum(self.files.values()) / 1024. / 1024., self.hits, self.misses, self.evictions)
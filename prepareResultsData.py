@@ -3,21 +3,65 @@ import os
 import ROOT
 
 import datacard
+import columnCache
+import manifest
+import scaleFactors
+import yieldCache
 
 from stack import Group
 import locations
 from GammaL.config import stackConfigs
+
+SOURCEDIR = '/afs/cern.ch/user/y/yiiyama/output/GammaL/main'
+
+# channels are the bins of photon pt x ht x met, separately for each lepton
+CHANNELAXES = [
+    ('photon.pt[0]', [-float('inf'), 80., float('inf')], ['LowPt', 'HighPt']),
+    ('ht', [-float('inf'), 100., 400., float('inf')], ['LowHt', 'MidHt', 'HighHt']),
+    ('met', [120., 200., 300., 8000.], ['120', '200', '300'])
+]
+
+BINNINGS = [
+    ('el', 'Electron', 'FloatingVGammaE', datacard.Binning('(mass2 < 81. || mass2 > 101.) && mt >= 100.', CHANNELAXES)),
+    ('mu', 'Muon', 'FloatingVGammaM', datacard.Binning('mt >= 100.', CHANNELAXES))
+]
         
+def bookChannel(channel):
+    """
+    Book the rates setupChannel will ask for, so that each sample is read only once for all channels.
+    """
+
+    for group in stackConfigs[channel.stackName].groups:
+        if group.category == Group.OBSERVED:
+            for sample in group.samples:
+                datacard.bookSystematics(sample, channel, [])
+
+        elif group.category == Group.BACKGROUND:
+            for sample in group.samples:
+                datacard.bookSystematics(sample, channel, NUISANCES.get(group.name, []))
+
+
+def makeChannels(binnings):
+    """
+    Channels (name -> Channel) of all bins of the (lep, lepton, stack, binning) list.
+    """
+
+    channels = {}
+    for lep, lepton, stack, binning in binnings:
+        for index in binning.indices():
+            channelName = lep + binning.label(index)
+            channels[channelName] = datacard.Channel(channelName, lepton, stack, binning.cut(index), binning, index)
+
+    return channels
+
+
 def setupChannel(channel):
 
     groups = stackConfigs[channel.stackName].groups
 
-    scaleSource = ROOT.TFile.Open('/afs/cern.ch/user/y/yiiyama/output/GammaL/main/' + channel.stackName + '.root')
-    vgscale = scaleSource.Get('TemplateFitError/VGamma').GetY()[0]
-    scaleGr = scaleSource.Get('TemplateFitError/VGammaNoEff')
-    vgscaleRelErr = datacard.boundVal(scaleGr.GetErrorY(0) / scaleGr.GetY()[0])
-    jlscale = scaleSource.Get('TemplateFitError/QCD').GetY()[0]
-    scaleSource.Close()
+    vgscale = scaleFactors.getScale(channel.stackName, 'VGamma')
+    vgscaleRelErr = datacard.boundVal(scaleFactors.getError(channel.stackName, 'VGammaNoEff') / scaleFactors.getScale(channel.stackName, 'VGammaNoEff'))
+    jlscale = scaleFactors.getScale(channel.stackName, 'QCD')
 
     for group in groups:
         if group.category == Group.OBSERVED:
@@ -62,7 +106,6 @@ def setupChannel(channel):
             else:
                 if group.name == 'VGamma':
                     process.nuisances['vgscale'] = vgscaleRelErr
-                    process.nuisances['vgshape'] = vgshape(group, channel, vgscale, process.rate())
                     scale = vgscale
     
                 elif group.name == 'EWK':
@@ -71,54 +114,94 @@ def setupChannel(channel):
                     process.nuisances['ewkxsec'] = 0.5
                     scale = 1.
 
-                process.nuisances['jes'] = datacard.getJESUncert([(sample, scale) for sample in group.samples], channel.cut, process.rate())
-                process.nuisances['jer'] = datacard.getJERUncert([(sample, scale) for sample in group.samples], channel.cut, process.rate())
+                process.nuisances.update(datacard.getShifts([(sample, scale) for sample in group.samples], channel, process.rate(), NUISANCES[group.name]))
 
 
-def vgshape(group, channel, vgscale, nominal):
-    leptonPtSource = ROOT.TFile.Open('/afs/cern.ch/user/y/yiiyama/output/GammaL/main/dimuonPt_binned.root')
-    ptlWeight = leptonPtSource.Get('ratio')
+def renormalize(channels):
+    """
+    Normalize the VGamma jes and jer shifts of all channels to the rate-weighted average shift.
+    """
 
-    rate = 0.
-    for sample in group.samples:
-        if sample.name in datacard.treeStore:
-            tree = datacard.treeStore[sample.name]
-        else:
-            sample.loadTree(locations.eventListDir)
-            tree = sample.tree
-
-        tree.SetEstimate(tree.GetEntries() + 1)
-        if channel.lepton == 'Electron':
-            ptVar = 'electron.pt[0]'
-        elif channel.lepton == 'Muon':
-            ptVar = 'muon.pt[0]'
-
-        nEntries = tree.Draw(ptVar + ':eventSigma * ' + datacard.LUMI + ' * puWeight * effScale', channel.cut, 'goff')
-        ptArr = tree.GetV1()
-        wArr = tree.GetV2()
-        for iE in range(nEntries):
-            iBin = ptlWeight.FindFixBin(ptArr[iE])
-            if iBin == 0: iBin = 1
-            elif iBin == ptlWeight.GetNbinsX() + 1: iBin = ptlWeight.GetNbinsX()
-
-            rate += ptlWeight.GetBinContent(iBin) * wArr[iE]
-
-        if sample.name not in datacard.treeStore:
-            tree = None
-            sample.releaseTree()
+    totalNumer = {'jes': 0., 'jer': 0.}
+    totalDenom = 0.
+    for channel in channels.values():
+        proc = channel.processes['VGamma']
+        for nuis in totalNumer.keys():
+            totalNumer[nuis] += proc.nuisances[nuis] * proc.rate()
+        totalDenom += proc.rate()
+
+    for channel in channels.values():
+        proc = channel.processes['VGamma']
+        for nuis in totalNumer.keys():
+            proc.nuisances[nuis] = (1. + proc.nuisances[nuis]) / (1. + totalNumer[nuis] / totalDenom) - 1.
+
+
+def channelSamples(channel):
+    return [sample for group in stackConfigs[channel.stackName].groups if group.category in [Group.OBSERVED, Group.BACKGROUND] for sample in group.samples]
+
+
+def channelFingerprint(channel):
+    """
+    Digest of the inputs of one channel: definition, stack template fit, VGamma lepton pT ratio and the observed and background samples.
+    """
+
+    parts = [manifest.channelDefinition(channel), manifest.fileFingerprint(SOURCEDIR + '/' + channel.stackName + '.root'), manifest.fileFingerprint(SOURCEDIR + '/dimuonPt_binned.root')]
+    parts += [manifest.sampleFingerprint(sample, locations.eventListDir) for sample in channelSamples(channel)]
+
+    return manifest.digest(parts)
+
+
+def loadPtlWeight():
+    """
+    Lepton pT reweighting of VGamma (dimuon pT data/MC ratio) as the lookup function ptlWeight, read from the histogram once.
+    """
+
+    if 'ptlWeight' in columnCache.LOOKUPS:
+        return
+
+    leptonPtSource = ROOT.TFile.Open(SOURCEDIR + '/dimuonPt_binned.root')
+    ratio = leptonPtSource.Get('ratio')
+
+    axis = ratio.GetXaxis()
+    nBins = ratio.GetNbinsX()
+
+    edges = [axis.GetBinLowEdge(iBin) for iBin in range(1, nBins + 1)] + [axis.GetBinUpEdge(nBins)]
+    contents = [ratio.GetBinContent(iBin) for iBin in range(1, nBins + 1)]
+
+    leptonPtSource.Close()
 
-    rate *= vgscale
+    columnCache.LOOKUPS['ptlWeight'] = columnCache.Lookup(edges, contents)
 
-    return datacard.boundVal(abs(rate - nominal) / nominal)
 
+def vgshapeWeight(channel):
+    """
+    Event weight expression of the VGamma lepton pT reweighting. Values below and above the histogram range take the first and last bin contents.
+    """
+
+    loadPtlWeight()
+
+    if channel.lepton == 'Electron':
+        return 'ptlWeight(electron.pt[0])'
+    elif channel.lepton == 'Muon':
+        return 'ptlWeight(muon.pt[0])'
+
+
+datacard.addSystematic(datacard.Systematic('vgshape', datacard.Variation(weight = vgshapeWeight), absolute = True, threshold = 0.))
+
+NUISANCES = {'VGamma': ['jes', 'jer', 'vgshape'], 'EWK': ['jes', 'jer']} # systematics computed from the yields
 
 if __name__ == '__main__':
 
     import sys
+    import copy
     import pickle
     from optparse import OptionParser
 
     parser = OptionParser(usage = 'Usage: prepareResultsData.py [options] outputName')
+    parser.add_option('-c', '--columns', dest = 'columns', action = 'store_true', help = 'evaluate cuts on cached columns (columnCache) instead of trees')
+    parser.add_option('-f', '--scale-cache', dest = 'scaleCache', default = '', help = 'directory to keep the template-fit scale factors in between runs')
+    parser.add_option('-i', '--incremental', dest = 'incremental', action = 'store_true', help = 'recompute only the channels whose inputs changed since the last incremental run (see manifest) and update the existing output; input fingerprints are computed and recorded only with this option')
+    parser.add_option('-y', '--yield-cache', dest = 'yieldCache', default = '', help = 'directory to save fine-binned yields of each sample in, for rebinning studies (rebinChannels.py)')
 
     options, args = parser.parse_args()
 
@@ -131,7 +214,54 @@ if __name__ == '__main__':
         print 'Output name must end with .pkl'
         sys.exit(1)
 
-    if os.path.exists(os.environ['TMPDIR'] + '/prepareResultsData_tmp.root'):
+    if options.columns and options.yieldCache:
+        # cached columns are evaluated per cut and do not fill the yield book
+        raise RuntimeError('Yield cache cannot be filled from cached columns')
+
+    scaleFactors.SIDECARDIR = options.scaleCache
+
+    outputPath = '/afs/cern.ch/user/y/yiiyama/output/GammaL/limits/' + outputName
+
+    channels = makeChannels(BINNINGS)
+
+    # channels before the VGamma renormalization (which depends on all channels) are kept in [output].raw so that single channels can be replaced
+
+    inputManifest = manifest.Manifest(outputPath)
+
+    if options.incremental:
+        # fingerprinting opens every input file, so it is done only when the manifest is used
+        fingerprints = dict([(name, channelFingerprint(channel)) for name, channel in channels.items()])
+
+    rawChannels = {}
+    if options.incremental and os.path.exists(outputPath + '.raw'):
+        with open(outputPath + '.raw', 'rb') as source:
+            rawChannels = pickle.load(source)
+
+        for name in channels.keys():
+            if name in rawChannels and inputManifest.upToDate(name, fingerprints[name]):
+                channels[name] = rawChannels[name]
+
+    else:
+        inputManifest.fingerprints = {}
+
+    outdated = [name for name in sorted(channels.keys()) if channels[name] is not rawChannels.get(name)]
+
+    print len(outdated), 'channels to compute'
+
+    samples = {}
+    for name in outdated:
+        for sample in channelSamples(channels[name]):
+            samples[sample.name] = sample
+
+    if len(samples) == 0:
+        tmpFile = None
+
+    elif options.columns:
+        tmpFile = None
+        for sample in samples.values():
+            datacard.columnStore[sample.name] = columnCache.Evaluator(columnCache.getColumns(sample, locations.eventListDir))
+
+    elif os.path.exists(os.environ['TMPDIR'] + '/prepareResultsData_tmp.root'):
         print 'Using pre-made skim'
         tmpFile = ROOT.TFile.Open(os.environ['TMPDIR'] + '/prepareResultsData_tmp.root')
         for key in tmpFile.GetListOfKeys():
@@ -140,20 +270,12 @@ if __name__ == '__main__':
 
     else:
         tmpFile = ROOT.TFile.Open(os.environ['TMPDIR'] + '/prepareResultsData_tmp.root', 'recreate')
-        samples = set([])
-        for stackName in ['FloatingVGammaE', 'FloatingVGammaM']:
-            for group in stackConfigs[stackName].groups:
-                if group.category == Group.SIGNAL: continue
-                for sample in group.samples:
-                    samples.add(sample)
     
-        for sample in samples:
+        for sample in samples.values():
             print 'Skimming', sample.name
             sample.loadTree(locations.eventListDir)
             tmpFile.cd()
-            suffices = ['', 'JESUp', 'JESDown', 'Smeared', 'SmearedUp', 'SmearedDown']
-            selection = '||'.join(['(mt{suffix} >= 100. && met{suffix} >= 120.)'.format(suffix = s) for s in suffices])
-            tree = sample.tree.CopyTree(selection)
+            tree = sample.tree.CopyTree(columnCache.SKIMSELECTION)
             sample.releaseTree()
             tree.SetName('eventList_' + sample.name)
             datacard.treeStore[sample.name] = tree
@@ -163,34 +285,43 @@ if __name__ == '__main__':
 
     # setup background and observed
 
-    channels = {}
-    for lep, lepton, chCut, stack in [('el', 'Electron', '(mass2 < 81. || mass2 > 101.) && ', 'FloatingVGammaE'), ('mu', 'Muon', '', 'FloatingVGammaM')]:
-        for ptCutName, ptCut in [('LowPt', 'photon.pt[0] < 80.'), ('HighPt', 'photon.pt[0] >= 80.')]:
-            for htCutName, htCut in [('LowHt', 'ht < 100.'), ('MidHt', 'ht >= 100. && ht < 400.'), ('HighHt', 'ht >= 400.')]:
-                for metLow, metHigh in [(120., 200.), (200., 300.), (300., 8000.)]:
-                    cut = chCut + 'mt >= 100. && {ptCut} && {htCut} && met >= {metLow} && met < {metHigh}'.format(ptCut = ptCut, htCut = htCut, metLow = metLow, metHigh = metHigh)
-                    channelName = lep + ptCutName + htCutName + str(int(metLow))
-                    
-                    print channelName
-                    ch = datacard.Channel(channelName, lepton, stack, cut)
-                    setupChannel(ch)
-                    channels[channelName] = ch
+    for name in outdated:
+        bookChannel(channels[name])
 
-    # renormalize VGamma uncertainties
-    totalNumer = {'jes': 0., 'jer': 0.}
-    totalDenom = 0.
-    for channel in channels.values():
-        proc = channel.processes['VGamma']
-        for nuis in totalNumer.keys():
-            totalNumer[nuis] += proc.nuisances[nuis] * proc.rate()
-        totalDenom += proc.rate()
+    fineChannels = {}
+    if options.yieldCache:
+        # fine bins are filled in the same pass as the channels
+        for name in outdated:
+            fine = yieldCache.fineChannel(channels[name])
+            fineChannels[(fine.stackName, fine.binning)] = fine
 
-    for channel in channels.values():
-        proc = channel.processes['VGamma']
-        for nuis in totalNumer.keys():
-            proc.nuisances[nuis] = (1. + proc.nuisances[nuis]) / (1. + totalNumer[nuis] / totalDenom) - 1.
+        for fine in fineChannels.values():
+            bookChannel(fine)
+
+    for name in outdated:
+        print name
+        setupChannel(channels[name])
+
+    if options.yieldCache:
+        for sample in samples.values():
+            yieldCache.save(options.yieldCache + '/' + sample.name + '.pkl', [sample], [fine.binning for fine in fineChannels.values()])
+
+    if tmpFile is not None:
+        tmpFile.Close()
+
+    with open(outputPath + '.raw', 'wb') as outputFile:
+        pickle.dump(channels, outputFile)
+
+    channels = copy.deepcopy(channels)
 
-    tmpFile.Close()
+    # renormalize VGamma uncertainties
+    renormalize(channels)
 
-    with open('/afs/cern.ch/user/y/yiiyama/output/GammaL/limits/' + outputName, 'wb') as outputFile:
+    with open(outputPath, 'wb') as outputFile:
         pickle.dump(channels, outputFile)
+
+    if options.incremental:
+        for name in outdated:
+            inputManifest.update(name, fingerprints[name])
+
+    inputManifest.save()
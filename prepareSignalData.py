@@ -2,88 +2,187 @@ import sys
 import os
 import math
 import array
+import glob
+import pickle
+import multiprocessing
 import ROOT
 
 import datacard
+import columnCache
+import signalStore
+import manifest
+import mirror
+import scaleFactors
+import yieldCache
 
 from GammaL.countSignal import getDataset
 
+SOURCEDIR = '/afs/cern.ch/user/y/yiiyama/output/GammaL/main'
+SIGNALDIR = 'rooth://ncmu40//store/countSignal/'
+
 tmpFile = None
+USECOLUMNS = False
+MIRROR = None # mirror.Mirror of SIGNALDIR
+COMPONENTDIR = '' # if set, yields of each component point are cached in [COMPONENTDIR]/[model]/[point].pkl and shared by all models containing the component
+YIELDDIR = '' # if set, fine-binned yields of each component point are saved in [YIELDDIR]/[model]/[point].pkl (see yieldCache)
+INCREMENTAL = False # if True, cached components are also checked against the fingerprints of the sample trees
 
 class ISRDatabase(object):
+    """
+    ISR normalization (nEvents / sumOfWeights) by point name, indexed once at construction.
+    """
+
     def __init__(self):
-        self.source = ROOT.TFile.Open('/afs/cern.ch/user/y/yiiyama/output/GammaL/main/isrWeights.root')
-        self.tree = self.source.Get('isrWeights')
+        source = ROOT.TFile.Open(SOURCEDIR + '/isrWeights.root')
+        tree = source.Get('isrWeights')
 
-        self.vPointName = array.array('c', ['\0'] * 100)
-        self.vNEvents = array.array('I', [0])
-        self.vSumOfWeights = array.array('d', [0.])
+        vPointName = array.array('c', ['\0'] * 100)
+        vNEvents = array.array('I', [0])
+        vSumOfWeights = array.array('d', [0.])
 
-        self.tree.SetBranchAddress('pointName', self.vPointName)
-        self.tree.SetBranchAddress('nEvents', self.vNEvents)
-        self.tree.SetBranchAddress('sumOfWeights', self.vSumOfWeights)
+        tree.SetBranchAddress('pointName', vPointName)
+        tree.SetBranchAddress('nEvents', vNEvents)
+        tree.SetBranchAddress('sumOfWeights', vSumOfWeights)
 
-    def __del__(self):
-        self.source.Close()
+        self.scales = {} # point name -> scale
+        self.resolved = {} # query -> point name
 
-    def getScale(self, pointFullName):
         iEntry = 0
-        while self.tree.GetEntry(iEntry) > 0:
-            if pointFullName in self.vPointName.tostring().strip():
-                return self.vNEvents[0] / self.vSumOfWeights[0]
+        while tree.GetEntry(iEntry) > 0:
             iEntry += 1
 
-        raise RuntimeError('Point ' + pointFullName + ' not found')
+            name = vPointName.tostring().split('\0')[0].strip()
+            if name not in self.scales:
+                self.scales[name] = vNEvents[0] / vSumOfWeights[0]
+
+        source.Close()
+
+    def getScale(self, pointFullName):
+        """
+        Scale for the point whose name contains pointFullName (an exact match takes precedence). Raises if no or more than one point matches.
+        """
+
+        if pointFullName in self.scales:
+            return self.scales[pointFullName]
+
+        if pointFullName not in self.resolved:
+            matches = [name for name in self.scales if pointFullName in name]
+
+            if len(matches) == 0:
+                raise RuntimeError('Point ' + pointFullName + ' not found')
+            elif len(matches) > 1:
+                raise RuntimeError('Point ' + pointFullName + ' is ambiguous: ' + ' '.join(sorted(matches)))
+
+            self.resolved[pointFullName] = matches[0]
+
+        return self.scales[self.resolved[pointFullName]]
+
 
 isrDatabase = ISRDatabase()
 
-def getISRUncert(model, pointName, samplesAndScales, cut, nominal):
+def isrWeight(model, pointName):
 
     scale = isrDatabase.getScale(model + '_' + pointName)
     wstrs = []
     for low, high, w in [(0., 120., 1.), (120., 150., 0.95), (150., 250., 0.90), (250., 8000., 0.8)]:
         wstrs.append('(genBoost > %.0f && genBoost <= %.0f) * %f' % (low, high, w * scale))
 
-    weight = ' + '.join(wstrs)
-
-    rate = 0.
-    for sample, s in samplesAndScales:
-        rate += datacard.getRateAndCount(sample, cut, weight)[0] * s
-
-    shift = (rate - nominal) / nominal
-
-    if abs(shift) < 5.e-4: return 0.
-
-    return datacard.boundVal(shift)
+    return ' + '.join(wstrs)
 
 
-def setSignal(model, pointName, processes, genInfo, channels, ratescale):
+def componentYields(model, pointName, channels):
+    """
+    Yields of one component point as (GenInfo, {channel name: (rate, count, {systematic: varied yields})}), or None if the point has no dataset.
+    The rate is the background-subtracted candidate yield clipped at 0, before any model rate scale. The varied yields are the unscaled sums entering Systematic.shift.
+    """
 
     dataset = getDataset(model, pointName)
-    if not dataset: return
+    if not dataset: return None
 
-    genInfo[model + '_' + pointName] = datacard.GenInfo(dataset.sigma, dataset.sigmaRelErr, dataset.nEvents)
+    genInfo = datacard.GenInfo(dataset.sigma, dataset.sigmaRelErr, dataset.nEvents)
+
+    datacard.treeStore.pin([sample.name for sample in dataset.samples.values()])
 
     for sample in dataset.samples.values():
-        if sample.name not in datacard.treeStore:
+        if USECOLUMNS:
+            datacard.columnStore[sample.name] = columnCache.Evaluator(columnCache.getColumns(sample, SIGNALDIR + model))
+        elif sample.name not in datacard.treeStore:
+            if MIRROR is not None:
+                sourceDir = MIRROR.localDir(sample, SIGNALDIR + model)
+            else:
+                sourceDir = SIGNALDIR + model
+
             if tmpFile is not None:
-                sample.loadTree('rooth://ncmu40//store/countSignal/' + model)
+                sample.loadTree(sourceDir)
                 tmpFile.cd()
-                suffices = ['', 'JESUp', 'JESDown', 'Smeared', 'SmearedUp', 'SmearedDown']
-                selection = '||'.join(['(mt{suffix} >= 100. && met{suffix} >= 120.)'.format(suffix = s) for s in suffices])
-                tree = sample.tree.CopyTree(selection)
+                tree = sample.tree.CopyTree(columnCache.SKIMSELECTION)
                 sample.releaseTree()
                 tree.SetName('eventList_' + sample.name)
-                datacard.treeStore[sample.name] = tree
+                datacard.treeStore.put(sample.name, tree, lambda tree = tree: datacard.dropTree(tree))
             else:
-                sample.loadTree('rooth://ncmu40//store/countSignal/' + model)
-                datacard.treeStore[sample.name] = sample.tree
+                sample.loadTree(sourceDir)
+                datacard.treeStore.putSample(sample)
+
+    # book all rates of the point so that each sample is read once for all channels and variations
+
+    isrSystematics = getISRSystematics(model, pointName)
 
-    stackNames = set([c.stackName for c in channels.values()])
-    scaleSources = dict([(s, ROOT.TFile('/afs/cern.ch/user/y/yiiyama/output/GammaL/main/' + s + '.root')) for s in stackNames])
+    fineChannels = {}
+    if YIELDDIR:
+        for channel in channels.values():
+            fine = yieldCache.fineChannel(channel)
+            fineChannels[(fine.stackName, fine.binning)] = fine
+
+    for channel in channels.values() + fineChannels.values():
+        for prefix in ['PhotonAnd', 'ElePhotonAnd', 'FakePhotonAnd', 'PhotonAndFake']:
+            datacard.bookSystematics(dataset.samples[prefix + channel.lepton], channel, isrSystematics)
+
+        datacard.bookSystematics(dataset.samples['PhotonAnd' + channel.lepton], channel, ['jes', 'jer'])
+
+    yields = datasetYields(dataset, channels, isrSystematics)
+
+    if YIELDDIR:
+        yieldCache.save(YIELDDIR + '/' + model + '/' + pointName + '.pkl', dataset.samples.values(), [fine.binning for fine in fineChannels.values()])
+
+    for sample in dataset.samples.values():
+        datacard.yieldBook.forget(sample)
+
+    if USECOLUMNS:
+        for sample in dataset.samples.values():
+            datacard.columnStore.pop(sample.name)
+    elif tmpFile is None:
+        for sample in dataset.samples.values():
+            if sample.name in datacard.treeStore:
+                datacard.treeStore.pop(sample.name)
+            sample.releaseTree()
+
+    if MIRROR is not None:
+        for sample in dataset.samples.values():
+            MIRROR.release(sample, SIGNALDIR + model)
+
+    return genInfo, yields
+
+
+def getISRSystematics(model, pointName):
+    """
+    List of the ISR systematics of the point. They are not registered in datacard.systematics since the variation weight differs between points.
+    """
+
+    if model == 'Spectra_gW':
+        return []
+
+    return [datacard.Systematic('isr', datacard.Variation(weight = isrWeight(model, pointName)))]
+
+
+def datasetYields(dataset, channels, isrSystematics):
+    """
+    {channel name: (rate, count, {systematic: varied yields})} of the dataset samples, from booked (or cached) yields.
+    """
+
+    yields = {}
 
     for channelName, channel in channels.items():
-        jlScale = scaleSources[channel.stackName].Get('TemplateFitError/QCD').GetY()[0]
+        jlScale = scaleFactors.getScale(channel.stackName, 'QCD')
 
         candSample = dataset.samples['PhotonAnd' + channel.lepton]
         egSample = dataset.samples['ElePhotonAnd' + channel.lepton]
@@ -97,6 +196,78 @@ def setSignal(model, pointName, processes, genInfo, channels, ratescale):
 
         if rate < 0.: rate = 0.
 
+        varied = {}
+
+        if rate != 0.:
+            for name in ['jes', 'jer']:
+                varied[name] = datacard.getVariedYields([(candSample, 1.)], channel, name)
+
+            samplesAndScales = [(candSample, 1.), (egSample, -1.), (jgSample, -1.), (jlSample, -jlScale)]
+            for systematic in isrSystematics:
+                varied[systematic.name] = datacard.getVariedYields(samplesAndScales, channel, systematic)
+
+        yields[channelName] = (rate, count, varied)
+
+    return yields
+
+
+def getComponent(model, pointName, channels):
+    """
+    componentYields, read from [COMPONENTDIR]/[model]/[pointName].pkl if the inputs of the component are unchanged since it was computed.
+    The cache is keyed on componentKey, which does not open the sample trees. With INCREMENTAL, the sample tree fingerprints (already computed for the manifest) must match too.
+    """
+
+    if not COMPONENTDIR:
+        return componentYields(model, pointName, channels)
+
+    key = componentKey(model, pointName, channels)
+    if INCREMENTAL:
+        fingerprint = componentFingerprint(model, pointName, channels)
+    else:
+        fingerprint = None
+
+    cacheName = COMPONENTDIR + '/' + model + '/' + pointName + '.pkl'
+
+    try:
+        with open(cacheName, 'rb') as source:
+            cachedKey, cachedFingerprint, component = pickle.load(source)
+        # recomputed if the fine-binned yields are requested but missing
+        if cachedKey == key and (not INCREMENTAL or cachedFingerprint == fingerprint) and (not YIELDDIR or os.path.exists(YIELDDIR + '/' + model + '/' + pointName + '.pkl')):
+            return component
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        pass
+
+    component = componentYields(model, pointName, channels)
+    if component is None:
+        return None
+
+    try:
+        os.makedirs(COMPONENTDIR + '/' + model)
+    except OSError:
+        pass
+
+    # workers may write the same component concurrently
+    tmpName = cacheName + '.tmp' + str(os.getpid())
+    with open(tmpName, 'wb') as output:
+        pickle.dump((key, fingerprint, component), output, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpName, cacheName)
+
+    return component
+
+
+def addComponent(model, pointName, component, processes, genInfo, ratescale):
+    """
+    Add the component yields, scaled by ratescale, to the signal processes. Nuisances are averaged over the components weighted by their rates.
+    """
+
+    componentGenInfo, yields = component
+
+    genInfo[model + '_' + pointName] = componentGenInfo
+
+    systematics = dict(datacard.systematics)
+    systematics.update([(systematic.name, systematic) for systematic in getISRSystematics(model, pointName)])
+
+    for channelName, (rate, count, varied) in yields.items():
         rate *= ratescale
 
         if channelName not in processes:
@@ -108,69 +279,163 @@ def setSignal(model, pointName, processes, genInfo, channels, ratescale):
             process.nuisances['lumi'] = 0.026
             process.nuisances['effcorr'] = 0.08
 
+            # nominal includes the rate scale but the varied yields do not, as in the original per-point computation
+            shifts = dict([(name, systematics[name].shift(rate, *variedYields)) for name, variedYields in varied.items()])
+
             if model == 'Spectra_gW':
                 process.nuisances['isr'] = 0.05
-            else:
-                samplesAndScales = [(candSample, 1.), (egSample, -1.), (jgSample, -1.), (jlSample, -jlScale)]
-                isrUncert = getISRUncert(model, pointName, samplesAndScales, channel.cut, rate)
-    
-                if 'isr' in process.nuisances:
-                    isrUncert *= rate
-                    isrUncert += process.nuisances['isr'] * process.rate()
-                    isrUncert /= (rate + process.rate())
-    
-                process.nuisances['isr'] = isrUncert
 
-            jesUncert = datacard.getJESUncert([(candSample, 1.)], channel.cut, rate)
+            # rate-weighted average with the components already added to the process
+            for name, shift in shifts.items():
+                if name in process.nuisances:
+                    shift *= rate
+                    shift += process.nuisances[name] * process.rate()
+                    shift /= (rate + process.rate())
 
-            if 'jes' in process.nuisances:
-                jesUncert *= rate
-                jesUncert += process.nuisances['jes'] * process.rate()
-                jesUncert /= (rate + process.rate())
+                process.nuisances[name] = shift
 
-            process.nuisances['jes'] = jesUncert
+        process.addRate(model + '_' + pointName, rate, count)
 
-            jerUncert = datacard.getJERUncert([(candSample, 1.)], channel.cut, rate)
 
-            if 'jer' in process.nuisances:
-                jerUncert *= rate
-                jerUncert += process.nuisances['jer'] * process.rate()
-                jerUncert /= (rate + process.rate())
+def computePoint(model, point, components, channels, ratescale):
+    """
+    (processes, genInfo) of one point, summing its components.
+    """
 
-            process.nuisances['jer'] = jerUncert
+    pointName = model + '_' + point
+    print pointName
+    sys.stdout.flush()
 
-        process.addRate(model + '_' + pointName, rate, count)
+    processes = {} # channel -> Process [.rates: componentPoint -> rate & count]
+    genInfo = {} # componentPoint -> GenInfo
+    for component, componentPoint in components:
+        yields = getComponent(component, componentPoint, channels)
+        if yields is not None:
+            addComponent(component, componentPoint, yields, processes, genInfo, ratescale)
 
-    for source in scaleSources.values():
-        source.Close()
+    return processes, genInfo
 
-    if tmpFile is None:
-        for sample in dataset.samples.values():
-            datacard.treeStore.pop(sample.name)
-            sample.releaseTree()
 
+def computePoints(model, points, channels, ratescale, data):
+    """
+    Compute the points into the signal store, committing each point as soon as it is computed. With a mirror, the samples of the next point are copied in the background while the current point is processed.
+    """
 
-if __name__ == '__main__':
-    import sys
-    import pickle
-    from optparse import OptionParser
+    for iPoint, (point, components) in enumerate(points):
+        if MIRROR is not None and not USECOLUMNS and iPoint + 1 < len(points):
+            for component, componentPoint in points[iPoint + 1][1]:
+                dataset = getDataset(component, componentPoint)
+                if not dataset: continue
 
-    parser = OptionParser(usage = 'Usage: prepareSignalData.py [options] inputName')
-    parser.add_option('-p', '--point', dest = 'point', default = '')
-    parser.add_option('-m', '--model', dest = 'model', default = '')
+                for sample in dataset.samples.values():
+                    MIRROR.prefetch(sample, SIGNALDIR + component)
 
-    options, args = parser.parse_args()
+        data[model + '_' + point] = computePoint(model, point, components, channels, ratescale)
+        data.commit()
 
-    if len(args) != 1:
-        parser.print_usage()
-        sys.exit(1)
 
-    inputName = args[0]
+def mergeShard(data, shardName):
+    """
+    Move the points of a shard store into data. The shard file is removed once the points are committed.
+    """
 
-    with open('/afs/cern.ch/user/y/yiiyama/output/GammaL/limits/' + inputName) as source:
-        channels = pickle.load(source)
+    shard = signalStore.SignalStore(shardName)
+    for pointName, pointData in shard.items():
+        data[pointName] = pointData
+
+    shard.close()
+
+    data.commit()
+    os.remove(shardName)
+
+
+def componentInputs(model, pointName, channels):
+    """
+    Inputs of one component point that are known without opening the sample trees: dataset metadata, ISR weights, stack template fits and channel definitions.
+    """
+
+    parts = [model, pointName, manifest.fileFingerprint(SOURCEDIR + '/isrWeights.root')]
+    parts += [manifest.channelDefinition(channels[name]) for name in sorted(channels.keys())]
+    parts += [manifest.fileFingerprint(SOURCEDIR + '/' + s + '.root') for s in sorted(set([c.stackName for c in channels.values()]))]
+
+    dataset = getDataset(model, pointName)
+    if dataset:
+        parts.append((dataset.sigma, dataset.sigmaRelErr, dataset.nEvents, sorted(dataset.samples.keys())))
+
+    return parts
+
+
+def componentKey(model, pointName, channels):
+    return manifest.digest(componentInputs(model, pointName, channels))
+
+
+def componentFingerprint(model, pointName, channels):
+    """
+    Digest of the inputs of one component point (componentInputs) and the fingerprints of its sample trees.
+    """
+
+    parts = componentInputs(model, pointName, channels)
+
+    dataset = getDataset(model, pointName)
+    if dataset:
+        for name in sorted(dataset.samples.keys()):
+            parts.append(manifest.sampleFingerprint(dataset.samples[name], SIGNALDIR + model))
+
+    return manifest.digest(parts)
+
+
+def pointFingerprint(components, channels, ratescale):
+    return manifest.digest([ratescale] + [componentFingerprint(component, componentPoint, channels) for component, componentPoint in components])
+
+
+def runShard(args):
+    """
+    Process pool worker: compute the given points with its own ISR database and skim file and write them to a shard store. Returns the shard file name.
+    """
+
+    global isrDatabase
+    global tmpFile
+    global MIRROR
 
-    tmpFile = ROOT.TFile.Open(os.environ['TMPDIR'] + '/writeDataCard_signal_tmp.root', 'recreate')
+    model, points, channels, ratescale, shardName, iShard, nShards = args
+
+    isrDatabase = ISRDatabase()
+
+    if MIRROR is not None:
+        # workers do not share mirror directories so that one cannot remove the files of another
+        MIRROR = mirror.Mirror(MIRROR.directory + '/shard' + str(iShard), MIRROR.maxBytes / nShards, MIRROR.verify)
+
+    if not USECOLUMNS:
+        tmpFile = ROOT.TFile.Open(os.environ['TMPDIR'] + '/writeDataCard_signal_tmp_' + str(os.getpid()) + '.root', 'recreate')
+
+    if os.path.exists(shardName):
+        os.remove(shardName)
+
+    data = signalStore.SignalStore(shardName, 'w')
+
+    computePoints(model, points, channels, ratescale, data)
+
+    data.close()
+
+    print datacard.treeStore.stats()
+    if MIRROR is not None:
+        print MIRROR.stats()
+
+    # release the trees copied into tmpFile and the yields of this shard; the pool can give this worker another shard
+    datacard.treeStore.clear()
+    datacard.yieldBook.clear()
+
+    if tmpFile is not None:
+        tmpFile.Close()
+        os.remove(tmpFile.GetName())
+
+    return shardName
+
+
+def modelPoints():
+    """
+    (pointList, scale): model -> {point -> [(component model, component point)]} and model -> rate scale (1 if absent).
+    """
 
     scale = {}
     pointList = {}
@@ -206,6 +471,67 @@ if __name__ == '__main__':
             pointList['Spectra_gW_nc']['M3_%d_M2_%d' % (m3, m2)] = [('Spectra_gW', 'M3_%d_M2_%d_%s' % (m3, m2, proc)) for proc in ['ncp', 'ncm']]
     scale['Spectra_gW_nc'] = 1. / 0.23
 
+    return pointList, scale
+
+
+if __name__ == '__main__':
+    import sys
+    import pickle
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = 'Usage: prepareSignalData.py [options] inputName')
+    parser.add_option('-p', '--point', dest = 'point', default = '')
+    parser.add_option('-m', '--model', dest = 'model', default = '')
+    parser.add_option('-t', '--max-trees', dest = 'maxTrees', type = 'int', default = 0, help = 'maximum number of skimmed trees kept in memory (least recently used are dropped)')
+    parser.add_option('-s', '--max-tree-mb', dest = 'maxTreeMB', type = 'int', default = 0, help = 'maximum total size of skimmed trees kept in memory in MB')
+    parser.add_option('-j', '--jobs', dest = 'jobs', type = 'int', default = 1, help = 'number of worker processes; the points of a model are split into one shard per worker and merged at the end')
+    parser.add_option('-c', '--columns', dest = 'columns', action = 'store_true', help = 'evaluate cuts on cached columns (columnCache) instead of trees')
+    parser.add_option('-M', '--mirror', dest = 'mirror', default = '', help = 'local directory to mirror the signal trees in')
+    parser.add_option('-G', '--mirror-gb', dest = 'mirrorGB', type = 'float', default = 0., help = 'size limit of the mirror in GB')
+    parser.add_option('-V', '--verify-mirror', dest = 'verifyMirror', action = 'store_true', help = 'verify the checksum of mirrored files before reusing them')
+    parser.add_option('-f', '--scale-cache', dest = 'scaleCache', default = '', help = 'directory to keep the template-fit scale factors in between runs')
+    parser.add_option('-k', '--component-cache', dest = 'componentCache', default = '', help = 'directory to cache the yields of each component point in, to be reused by all models containing it')
+    parser.add_option('-y', '--yield-cache', dest = 'yieldCache', default = '', help = 'directory to save fine-binned yields of each component point in, for rebinning studies (rebinChannels.py)')
+    parser.add_option('-i', '--incremental', dest = 'incremental', action = 'store_true', help = 'recompute only the points whose inputs changed since the last incremental run (see manifest) and update the existing output; input fingerprints are computed and recorded only with this option')
+    parser.add_option('-r', '--resume', dest = 'resume', action = 'store_true', help = 'continue an interrupted run: keep the points already in the output (and in leftover shards) and compute the rest')
+
+    options, args = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_usage()
+        sys.exit(1)
+
+    if options.incremental and options.resume:
+        # stale points are in the output too, so committed points cannot be told apart in incremental mode
+        raise RuntimeError('Incremental update cannot be resumed')
+
+    if options.columns and options.yieldCache:
+        # cached columns are evaluated per cut and do not fill the yield book
+        raise RuntimeError('Yield cache cannot be filled from cached columns')
+
+    inputName = args[0]
+
+    with open('/afs/cern.ch/user/y/yiiyama/output/GammaL/limits/' + inputName) as source:
+        channels = pickle.load(source)
+
+    datacard.treeStore.maxEntries = options.maxTrees
+    datacard.treeStore.maxBytes = options.maxTreeMB * 1024 * 1024
+
+    scaleFactors.SIDECARDIR = options.scaleCache
+    COMPONENTDIR = options.componentCache
+    YIELDDIR = options.yieldCache
+    INCREMENTAL = bool(options.incremental)
+
+    if options.mirror:
+        MIRROR = mirror.Mirror(options.mirror, int(options.mirrorGB * 1024 * 1024 * 1024), options.verifyMirror)
+
+    if options.columns:
+        USECOLUMNS = True
+    elif options.jobs <= 1:
+        tmpFile = ROOT.TFile.Open(os.environ['TMPDIR'] + '/writeDataCard_signal_tmp.root', 'recreate')
+
+    pointList, scale = modelPoints()
+
     if options.model:
         models = [options.model]
     else:
@@ -219,31 +545,93 @@ if __name__ == '__main__':
         outputFileName = '/afs/cern.ch/user/y/yiiyama/output/GammaL/limits/' + model
         if options.point:
             outputFileName += '_' + options.point
-        outputFileName += '.pkl'
+        outputFileName += '.db'
 
         if model in scale:
             ratescale = scale[model]
         else:
             ratescale = 1.
 
-        outputFile = open(outputFileName, 'wb')
-        data = {}
+        points = [(point, pointList[model][point]) for point in sorted(pointList[model].keys()) if not options.point or point == options.point]
 
-        for point in sorted(pointList[model].keys()):
-            if options.point and point != options.point: continue
+        inputManifest = manifest.Manifest(outputFileName)
 
-            pointName = model + '_' + point
-            print pointName
+        if options.incremental:
+            # fingerprinting opens every input file, so it is done only when the manifest is used
+            fingerprints = dict([(point, pointFingerprint(components, channels, ratescale)) for point, components in points])
+        else:
+            # points written without fingerprints invalidate the recorded ones
+            inputManifest.fingerprints = {}
+
+        if options.incremental and os.path.exists(outputFileName):
+            existing = signalStore.SignalStore(outputFileName)
+            points = [(point, components) for point, components in points if model + '_' + point not in existing or not inputManifest.upToDate(model + '_' + point, fingerprints[point])]
+            existing.close()
+
+            print model, len(points), 'points to update'
+
+        elif not options.resume:
+            if os.path.exists(outputFileName):
+                os.remove(outputFileName)
+
+            inputManifest.fingerprints = {}
+
+        leftoverShards = sorted(glob.glob(os.environ['TMPDIR'] + '/' + model + '_shard*.db'))
+
+        resumed = []
+        if options.resume:
+            data = signalStore.SignalStore(outputFileName, 'w')
+
+            for shardName in leftoverShards:
+                print 'Merging leftover shard', shardName
+                mergeShard(data, shardName)
+
+            resumed = [(point, components) for point, components in points if model + '_' + point in data]
+            points = [(point, components) for point, components in points if model + '_' + point not in data]
+
+            data.close()
+
+            print model, len(resumed), 'points already done,', len(points), 'to compute'
+
+        else:
+            for shardName in leftoverShards:
+                os.remove(shardName)
+
+        if options.jobs > 1 and len(points) > 1:
+            nShards = min(options.jobs, len(points))
+            shards = [(model, points[iShard::nShards], channels, ratescale, os.environ['TMPDIR'] + '/' + model + '_shard' + str(iShard) + '.db', iShard, nShards) for iShard in range(nShards)]
+
+            pool = multiprocessing.Pool(nShards)
+            shardNames = pool.map(runShard, shards, chunksize = 1)
+            pool.close()
+            pool.join()
+
+        else:
+            shardNames = []
+
+        data = signalStore.SignalStore(outputFileName, 'w')
+
+        if len(shardNames) != 0:
+            print 'Merging', len(shardNames), 'shards'
+
+            for shardName in shardNames:
+                mergeShard(data, shardName)
+
+        else:
+            computePoints(model, points, channels, ratescale, data)
 
-            processes = {} # channel -> Process [.rates: componentPoint -> rate & count]
-            genInfo = {} # componentPoint -> GenInfo
-            for component, componentPoint in pointList[model][point]:
-                setSignal(component, componentPoint, processes, genInfo, channels, ratescale)
+        data.close()
 
-            data[pointName] = (processes, genInfo)
+        # manifest is updated only once the points are safely in the output
+        if options.incremental:
+            for point, components in points:
+                inputManifest.update(model + '_' + point, fingerprints[point])
 
-        pickle.dump(data, outputFile)
+        inputManifest.save()
 
-        outputFile.close()
+    print datacard.treeStore.stats()
+    if MIRROR is not None:
+        print MIRROR.stats()
 
-    tmpFile.Close()
+    if tmpFile is not None:
+        tmpFile.Close()
@@ -0,0 +1,158 @@
+import sys
+import os
+import pickle
+
+import datacard
+import signalStore
+import scaleFactors
+import yieldCache
+import prepareResultsData
+import prepareSignalData
+
+from GammaL.countSignal import getDataset
+
+LABELPREFIXES = {'photon.pt[0]': 'Pt', 'ht': 'Ht', 'met': 'Met'}
+
+def makeAxes(edgesList):
+    """
+    Channel axes with the given edges per variable (in the order of CHANNELAXES). Axes with the default edges keep their labels.
+    """
+
+    axes = []
+    for (variable, defaultEdges, defaultLabels), edges in zip(prepareResultsData.CHANNELAXES, edgesList):
+        if edges == defaultEdges:
+            labels = defaultLabels
+        else:
+            labels = [LABELPREFIXES[variable] + str(iBin) for iBin in range(len(edges) - 1)]
+
+        axes.append((variable, edges, labels))
+
+    return axes
+
+
+def cachedComponentYields(cacheDir, model, pointName, channels):
+    """
+    componentYields of one component point, summed from the fine-binned yields in [cacheDir]/[model]/[pointName].pkl. None if the point has no dataset.
+    """
+
+    dataset = getDataset(model, pointName)
+    if not dataset: return None
+
+    cacheName = cacheDir + '/' + model + '/' + pointName + '.pkl'
+    if not os.path.exists(cacheName):
+        raise RuntimeError('No cached yields for ' + model + '_' + pointName)
+
+    genInfo = datacard.GenInfo(dataset.sigma, dataset.sigmaRelErr, dataset.nEvents)
+
+    isrSystematics = prepareSignalData.getISRSystematics(model, pointName)
+
+    yieldCache.inject(cacheName, set([channel.binning for channel in channels.values()]))
+
+    yields = prepareSignalData.datasetYields(dataset, channels, isrSystematics)
+
+    for sample in dataset.samples.values():
+        datacard.yieldBook.forget(sample)
+
+    return genInfo, yields
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage = 'Usage: rebinChannels.py [options] cacheDir outputDir\n  Builds the channels (and signal stores) of a new binning from the fine-binned yields saved by prepareResultsData.py -y and prepareSignalData.py -y.\n  Edges are comma-separated and must be a subset of yieldCache.FINEEDGES; use inf and -inf for open ends.')
+    parser.add_option('-p', '--pt-edges', dest = 'ptEdges', default = '', help = 'photon pt edges')
+    parser.add_option('-t', '--ht-edges', dest = 'htEdges', default = '', help = 'HT edges')
+    parser.add_option('-e', '--met-edges', dest = 'metEdges', default = '', help = 'MET edges')
+    parser.add_option('-o', '--output', dest = 'outputName', default = 'result.pkl', help = 'name of the channels pickle in outputDir')
+    parser.add_option('-m', '--models', dest = 'models', default = '', help = 'comma-separated list of signal models to write [outputDir]/[model].db for')
+    parser.add_option('-f', '--scale-cache', dest = 'scaleCache', default = '', help = 'directory to keep the template-fit scale factors in between runs')
+
+    options, args = parser.parse_args()
+
+    if len(args) != 2:
+        parser.print_usage()
+        sys.exit(1)
+
+    cacheDir = args[0]
+    outputDir = args[1]
+
+    scaleFactors.SIDECARDIR = options.scaleCache
+
+    # a yield missing from the cache is an error rather than a silent event loop
+    datacard.yieldBook.cachedOnly = True
+
+    edgesList = []
+    for (variable, defaultEdges, defaultLabels), edges in zip(prepareResultsData.CHANNELAXES, [options.ptEdges, options.htEdges, options.metEdges]):
+        if edges:
+            edgesList.append([float(edge) for edge in edges.split(',')])
+        else:
+            edgesList.append(defaultEdges)
+
+    axes = makeAxes(edgesList)
+
+    binnings = [(lep, lepton, stack, datacard.Binning(binning.preselection, axes)) for lep, lepton, stack, binning in prepareResultsData.BINNINGS]
+
+    channels = prepareResultsData.makeChannels(binnings)
+
+    print len(channels), 'channels'
+
+    # background and observed
+
+    binningObjects = [binning for lep, lepton, stack, binning in binnings]
+
+    sampleNames = set()
+    for channel in channels.values():
+        for sample in prepareResultsData.channelSamples(channel):
+            if sample.name in sampleNames: continue
+
+            cacheName = cacheDir + '/' + sample.name + '.pkl'
+            if not os.path.exists(cacheName):
+                raise RuntimeError('No cached yields for ' + sample.name)
+
+            yieldCache.inject(cacheName, binningObjects)
+            sampleNames.add(sample.name)
+
+    for name in sorted(channels.keys()):
+        prepareResultsData.setupChannel(channels[name])
+
+    prepareResultsData.renormalize(channels)
+
+    try:
+        os.makedirs(outputDir)
+    except OSError:
+        pass
+
+    with open(outputDir + '/' + options.outputName, 'wb') as outputFile:
+        pickle.dump(channels, outputFile)
+
+    # signal
+
+    if options.models:
+        pointList, scale = prepareSignalData.modelPoints()
+
+        for model in options.models.split(','):
+            if model in scale:
+                ratescale = scale[model]
+            else:
+                ratescale = 1.
+
+            outputFileName = outputDir + '/' + model + '.db'
+            if os.path.exists(outputFileName):
+                os.remove(outputFileName)
+
+            data = signalStore.SignalStore(outputFileName, 'w')
+
+            for point in sorted(pointList[model].keys()):
+                processes = {}
+                genInfo = {}
+                for component, componentPoint in pointList[model][point]:
+                    yields = cachedComponentYields(cacheDir, component, componentPoint, channels)
+                    if yields is not None:
+                        prepareSignalData.addComponent(component, componentPoint, yields, processes, genInfo, ratescale)
+
+                data[model + '_' + point] = (processes, genInfo)
+
+            data.commit()
+            data.close()
+
+            print model, len(pointList[model]), 'points'
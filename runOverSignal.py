@@ -5,6 +5,7 @@ import subprocess
 import time
 
 LOGDIR = os.environ['HOME'] + '/work/logs'
+POINTSPERJOB = 1 # >1: pass comma-separated point lists to scripts that accept them (computeLimits.sh)
 
 def runOnInteractiveNodes(points, script, nodePool, additionalArgs = []):
 
@@ -82,6 +83,16 @@ if __name__ == '__main__':
         if sPoints == 'Spectra_gW_gg':
             points += [('Spectra_gW_gg', 'M3_%d_M2_%d' % (m3, m2)) for m3 in range(715, 1565, 50) for m2 in range(205, m3, 50)]
 
+    if POINTSPERJOB > 1:
+        groups = []
+        for model, point in points:
+            if len(groups) != 0 and groups[-1][0] == model and len(groups[-1][1]) < POINTSPERJOB:
+                groups[-1][1].append(point)
+            else:
+                groups.append((model, [point]))
+
+        points = [(model, ','.join(group)) for model, group in groups]
+
     if re.match('^[18]n[hdw]$', nodePool):
         for model, point in points:
             jobName = model + '_' + point
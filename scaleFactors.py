@@ -0,0 +1,77 @@
+import os
+import json
+import ROOT
+
+SOURCEDIR = '/afs/cern.ch/user/y/yiiyama/output/GammaL/main'
+SIDECARDIR = '' # if set, the graphs are also saved to [SIDECARDIR]/[stack].json and read from there while the stack file is unchanged
+
+graphs = {} # stack name -> {graph name -> [(y, errorY)]}
+
+def readGraphs(stackName):
+    """
+    All TemplateFitError graphs of the stack file as {graph name -> [(y, errorY)]}.
+    """
+
+    source = ROOT.TFile.Open(SOURCEDIR + '/' + stackName + '.root')
+    if not source or source.IsZombie():
+        raise RuntimeError('Cannot open ' + SOURCEDIR + '/' + stackName + '.root')
+
+    directory = source.Get('TemplateFitError')
+    if not directory:
+        raise RuntimeError('No TemplateFitError in ' + stackName)
+
+    content = {}
+    for key in directory.GetListOfKeys():
+        if not key.GetClassName().startswith('TGraph'): continue
+
+        graph = key.ReadObj()
+        content[key.GetName()] = [(graph.GetY()[iP], graph.GetErrorY(iP)) for iP in range(graph.GetN())]
+
+    source.Close()
+
+    return content
+
+
+def load(stackName):
+    if stackName in graphs:
+        return graphs[stackName]
+
+    mtime = os.path.getmtime(SOURCEDIR + '/' + stackName + '.root')
+
+    if SIDECARDIR:
+        sidecarName = SIDECARDIR + '/' + stackName + '.json'
+        try:
+            with open(sidecarName) as source:
+                cached = json.load(source)
+            if cached['mtime'] == mtime:
+                graphs[stackName] = dict([(str(name), [tuple(point) for point in points]) for name, points in cached['graphs'].items()])
+                return graphs[stackName]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    graphs[stackName] = readGraphs(stackName)
+
+    if SIDECARDIR:
+        with open(sidecarName + '.tmp', 'w') as output:
+            json.dump({'mtime': mtime, 'graphs': graphs[stackName]}, output)
+        os.rename(sidecarName + '.tmp', sidecarName)
+
+    return graphs[stackName]
+
+
+def getScale(stackName, graphName, iPoint = 0):
+    """
+    Y value of point iPoint of TemplateFitError/[graphName] in the stack file.
+    """
+
+    try:
+        return load(stackName)[graphName][iPoint][0]
+    except KeyError:
+        raise RuntimeError('No TemplateFitError/' + graphName + ' in ' + stackName)
+
+
+def getError(stackName, graphName, iPoint = 0):
+    try:
+        return load(stackName)[graphName][iPoint][1]
+    except KeyError:
+        raise RuntimeError('No TemplateFitError/' + graphName + ' in ' + stackName)
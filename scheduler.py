@@ -0,0 +1,100 @@
+import subprocess
+import threading
+import multiprocessing
+import Queue
+
+class Job(object):
+    def __init__(self, name, command, logName, after, callback):
+        self.name = name
+        self.command = command
+        self.logName = logName
+        self.after = set(after)
+        self.callback = callback
+
+        self.proc = None
+        self.returncode = None
+
+
+class Scheduler(object):
+    """
+    Runs shell commands as a DAG with at most maxProcs concurrent processes. The main thread blocks until a child finishes (no polling).
+    Output of each job goes to its own log file; report(name, output) is called with the log content as each job completes.
+    Jobs can be added from a job callback while the scheduler is running (e.g. to chain further work that depends on the job output).
+    """
+
+    def __init__(self, maxProcs = 0, report = None):
+        if maxProcs <= 0:
+            maxProcs = multiprocessing.cpu_count()
+
+        self.maxProcs = maxProcs
+        self.report = report
+
+        self.jobs = []
+        self.pending = []
+
+    def add(self, name, command, logName, after = [], callback = None):
+        """
+        Add a job. It is started only after all jobs named in after have finished (regardless of their exit status). callback(returncode) is called when the job finishes.
+        """
+
+        for dep in after:
+            if dep not in [job.name for job in self.jobs]:
+                raise RuntimeError('Unknown dependency ' + dep + ' for job ' + name)
+
+        job = Job(name, command, logName, after, callback)
+
+        self.jobs.append(job)
+        self.pending.append(job)
+
+    def run(self):
+        """
+        Run all jobs and return a dict name -> return code.
+        """
+
+        finished = Queue.Queue()
+
+        def wait(job):
+            job.proc.wait()
+            finished.put(job)
+
+        pending = self.pending
+        running = []
+        done = set()
+
+        while len(pending) != 0 or len(running) != 0:
+            for job in list(pending):
+                if len(running) >= self.maxProcs: break
+                if len(job.after - done) != 0: continue
+
+                with open(job.logName, 'w') as log:
+                    job.proc = subprocess.Popen(job.command, shell = True, stdout = log, stderr = subprocess.STDOUT)
+
+                thread = threading.Thread(target = wait, args = (job,))
+                thread.daemon = True
+                thread.start()
+
+                pending.remove(job)
+                running.append(job)
+
+            if len(running) == 0:
+                raise RuntimeError('Circular job dependency')
+
+            job = finished.get()
+
+            job.returncode = job.proc.returncode
+            running.remove(job)
+            done.add(job.name)
+
+            if self.report is not None:
+                with open(job.logName) as log:
+                    self.report(job.name, log.read())
+
+            if job.callback is not None:
+                job.callback(job.returncode)
+
+        returncodes = dict([(job.name, job.returncode) for job in self.jobs])
+
+        self.jobs = []
+        self.pending = []
+
+        return returncodes
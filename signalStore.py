@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import pickle
+
+class SignalStore(object):
+    """
+    Signal data of a model (point name -> (processes, genInfo), as produced by prepareSignalData) in a SQLite file. Each point is pickled separately so that one point can be read without loading the whole model.
+    Supports the read-only dict interface used on the old {model}.pkl (store[pointName], keys(), items(), in, len).
+    """
+
+    def __init__(self, path, mode = 'r'):
+        if mode == 'r' and not os.path.exists(path):
+            raise RuntimeError('Signal store ' + path + ' does not exist')
+
+        self.path = path
+        self.mode = mode
+        self._db = None
+        self._pid = 0
+
+        if mode == 'w':
+            self.db().execute('CREATE TABLE IF NOT EXISTS points (name TEXT PRIMARY KEY, data BLOB)')
+            self.db().commit()
+
+    def db(self):
+        # connections cannot be shared with forked processes (multiprocessing workers)
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path)
+            self._pid = os.getpid()
+
+        return self._db
+
+    def __getitem__(self, pointName):
+        row = self.db().execute('SELECT data FROM points WHERE name = ?', (pointName,)).fetchone()
+        if row is None:
+            raise KeyError(pointName)
+
+        return pickle.loads(str(row[0]))
+
+    def __setitem__(self, pointName, data):
+        self.db().execute('INSERT OR REPLACE INTO points VALUES (?, ?)', (pointName, sqlite3.Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))))
+
+    def __contains__(self, pointName):
+        return self.db().execute('SELECT 1 FROM points WHERE name = ?', (pointName,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db().execute('SELECT COUNT(*) FROM points').fetchone()[0]
+
+    def keys(self):
+        return [str(row[0]) for row in self.db().execute('SELECT name FROM points ORDER BY name')]
+
+    def items(self):
+        """
+        Generator over (pointName, data); only one point is held in memory at a time.
+        """
+
+        for name, blob in self.db().execute('SELECT name, data FROM points ORDER BY name'):
+            yield str(name), pickle.loads(str(blob))
+
+    def commit(self):
+        self.db().commit()
+
+    def close(self):
+        if self._db is not None:
+            if self.mode == 'w':
+                self._db.commit()
+            self._db.close()
+            self._db = None
+
+
+def openSignals(datadir, model):
+    """
+    Signal data of the model from [datadir]/[model].db, or from the monolithic [datadir]/[model].pkl written by older versions of prepareSignalData.
+    """
+
+    if os.path.exists(datadir + '/' + model + '.db'):
+        return SignalStore(datadir + '/' + model + '.db')
+
+    with open(datadir + '/' + model + '.pkl', 'rb') as source:
+        return pickle.load(source)
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2 or not sys.argv[1].endswith('.pkl'):
+        print 'Usage: signalStore.py {model}.pkl'
+        print 'Converts a monolithic signal pickle into {model}.db'
+        sys.exit(1)
+
+    with open(sys.argv[1], 'rb') as source:
+        data = pickle.load(source)
+
+    store = SignalStore(sys.argv[1].replace('.pkl', '.db'), 'w')
+    for pointName, pointData in data.items():
+        store[pointName] = pointData
+
+    store.close()
@@ -0,0 +1,146 @@
+import os
+import pickle
+import numpy
+
+import datacard
+
+# fine edges of the channel axes; any binning rebuilt from the cache must use a subset of these edges
+FINEEDGES = {
+    'photon.pt[0]': [-float('inf'), 40., 50., 60., 70., 80., 90., 100., 120., 140., 160., 200., 300., float('inf')],
+    'ht': [-float('inf'), 50., 100., 150., 200., 250., 300., 400., 500., 600., 800., 1000., float('inf')],
+    'met': [120., 140., 160., 180., 200., 220., 250., 300., 350., 400., 500., 600., 8000.]
+}
+
+fineBinnings = {} # (preselection, variables) -> Binning
+
+def fineBinning(binning):
+    """
+    Binning with the FINEEDGES of the axes of binning, within the same preselection. One object per preselection and variables, so that the bookings of all channels sharing it are filled once.
+    """
+
+    variables = tuple([variable for variable, edges, labels in binning.axes])
+    key = (binning.preselection, variables)
+
+    if key not in fineBinnings:
+        axes = []
+        for variable in variables:
+            if variable not in FINEEDGES:
+                raise RuntimeError('No fine edges for ' + variable)
+
+            edges = FINEEDGES[variable]
+            axes.append((variable, edges, ['%g' % edge for edge in edges[:-1]]))
+
+        fineBinnings[key] = datacard.Binning(binning.preselection, axes)
+
+    return fineBinnings[key]
+
+
+def fineChannel(channel):
+    """
+    Pseudo-channel covering the fine binning of the channel, to be booked like the channel itself.
+    """
+
+    if getattr(channel, 'binning', None) is None:
+        raise RuntimeError('Channel ' + channel.name + ' is not a bin of a binning')
+
+    return datacard.Channel(channel.lepton + 'Fine', channel.lepton, channel.stackName, channel.binning.preselection, fineBinning(channel.binning))
+
+
+def save(fileName, samples, binnings):
+    """
+    Write the filled histograms (nominal and all booked variations) of the binnings for each sample to fileName as {sample name: [(preselection, axes, {(substitution, weight): (sumw, sumw2, count)})]}.
+    Entries already in the file for other preselections or axis variables (e.g. binnings not recomputed in an incremental run) are kept.
+    """
+
+    content = {}
+    for sample in samples:
+        entries = []
+        for binning in binnings:
+            histograms = datacard.yieldBook.getHistograms(sample, binning)
+            if len(histograms) != 0:
+                entries.append((binning.preselection, binning.axes, histograms))
+
+        if len(entries) != 0:
+            content[sample.name] = entries
+
+    if len(content) == 0:
+        return
+
+    try:
+        with open(fileName, 'rb') as source:
+            existing = pickle.load(source)
+    except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+        existing = {}
+
+    for sampleName, entries in existing.items():
+        if sampleName not in content:
+            content[sampleName] = entries
+            continue
+
+        replaced = [(preselection, [axis[0] for axis in axes]) for preselection, axes, histograms in content[sampleName]]
+        for preselection, axes, histograms in entries:
+            if (preselection, [axis[0] for axis in axes]) not in replaced:
+                content[sampleName].append((preselection, axes, histograms))
+
+    try:
+        os.makedirs(os.path.dirname(fileName))
+    except OSError:
+        pass
+
+    # workers may write the same file concurrently
+    tmpName = fileName + '.tmp' + str(os.getpid())
+    with open(tmpName, 'wb') as output:
+        pickle.dump(content, output, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpName, fileName)
+
+
+def rebin(fineAxes, axes, array):
+    """
+    Sum the bins of an array of the fine axes into the bins of axes. Fine bins outside of the range of axes are dropped.
+    """
+
+    for iAxis, ((fineVariable, fineEdges, fineLabels), (variable, edges, labels)) in enumerate(zip(fineAxes, axes)):
+        if variable != fineVariable:
+            raise RuntimeError('Axis ' + variable + ' does not match cached axis ' + fineVariable)
+
+        for edge in edges:
+            if edge not in fineEdges:
+                raise RuntimeError('Edge %s of %s is not in the cached binning' % (repr(edge), variable))
+
+        low = numpy.array(fineEdges[:-1])
+        high = numpy.array(fineEdges[1:])
+
+        matrix = numpy.zeros((len(edges) - 1, len(fineEdges) - 1))
+        for iBin in range(len(edges) - 1):
+            matrix[iBin, (low >= edges[iBin]) & (high <= edges[iBin + 1])] = 1.
+
+        array = numpy.moveaxis(numpy.tensordot(matrix, array, axes = ([1], [iAxis])), 0, iAxis)
+
+    return array
+
+
+def inject(fileName, binnings):
+    """
+    Fill the yield book with the bins of the binnings summed from the cached histograms in fileName, for all samples in the file. Returns the names of the samples.
+    Cached entries are used for the binnings with the same preselection and axis variables.
+    """
+
+    with open(fileName, 'rb') as source:
+        content = pickle.load(source)
+
+    for sampleName, entries in content.items():
+        for preselection, fineAxes, histograms in entries:
+            variables = [variable for variable, edges, labels in fineAxes]
+
+            for binning in binnings:
+                if binning.preselection != preselection or [variable for variable, edges, labels in binning.axes] != variables:
+                    continue
+
+                for (substitution, weight), (sumw, sumw2, count) in histograms.items():
+                    sumw = rebin(fineAxes, binning.axes, sumw)
+                    sumw2 = rebin(fineAxes, binning.axes, sumw2)
+                    count = numpy.rint(rebin(fineAxes, binning.axes, count)).astype(numpy.int64)
+
+                    datacard.yieldBook.addHistogram(sampleName, binning, substitution, weight, sumw, sumw2, count)
+
+    return content.keys()